@@ -0,0 +1,216 @@
+"""
+A scripted stand-in for an IRC server on localhost, enough for protoGen to
+register, join its channels, sync them with WHO and get ops. The load tests
+drive it from bench/loadtest.py; on its own it serves one channel and can
+replay a file of raw lines to whoever connects. With --caps it offers the
+IRCv3 capabilities protoGen asks for and sends NAMES with hosts on join.
+
+Usage: python3 bench/fakeircd.py [--port 6667] [--script lines.txt] [--delay 0] [--caps]
+"""
+import argparse
+import asyncio
+import itertools
+import time
+
+ISUPPORT = ('WHOX MODES=6 TARGMAX=KICK:4,JOIN:,PRIVMSG:4 MAXLIST=beI:100 PREFIX=(ov)@+ '
+            'CHANMODES=beI,k,l,imnpst CHANTYPES=# CASEMAPPING=rfc1459 NETWORK=Bench')
+CAPS = ('multi-prefix', 'userhost-in-names', 'extended-join', 'chghost', 'account-notify',
+        'away-notify', 'batch', 'message-tags')
+
+
+class FakeIRCd:
+    # Accepts one bot at a time. Every line the bot sends is kept in
+    # `received` as (perf_counter time, line) and passed to the listeners;
+    # sync() sends a PING and waits for the PONG, which the bot only sends
+    # after it has handled every line sent before it. caps are the IRCv3
+    # capabilities offered in CAP LS, none by default.
+    def __init__(self, name='fake.ircd', caps=()):
+        self.name = name
+        self.caps = set(caps)
+        self.acked = set()
+        self.server = None
+        self.writer = None
+        self.nick = None
+        self.channels = set()
+        self.received = []
+        self.listeners = []
+        self.connections = 0
+        self.registered = asyncio.Event()
+        self.joined = asyncio.Event()
+        self.whoed = asyncio.Event()
+        self.pongs = {}
+        self.tokens = itertools.count()
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.drop()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    def send(self, line):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write((line + '\r\n').encode())
+
+    def send_lines(self, lines):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(''.join(line + '\r\n' for line in lines).encode())
+
+    async def drain(self):
+        if self.writer is not None and not self.writer.is_closing():
+            await self.writer.drain()
+
+    async def sync(self, timeout=60):
+        # the time the bot caught up with everything sent so far
+        token = f"bench{next(self.tokens)}"
+        future = self.pongs[token] = asyncio.get_running_loop().create_future()
+        self.send('PING :' + token)
+        await self.drain()
+        return await asyncio.wait_for(future, timeout)
+
+    def drop(self):
+        # a forced disconnect, the way a netsplit looks to the bot
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.acked = set()
+        self.registered.clear()
+        self.joined.clear()
+        self.whoed.clear()
+        self.channels.clear()
+
+    async def handle(self, reader, writer):
+        if self.writer is not None:
+            writer.write(b'ERROR :Only one client\r\n')
+            writer.close()
+            return
+        self.writer = writer
+        self.connections += 1
+        user = False
+        negotiating = False
+        try:
+            while True:
+                data = await reader.readline()
+                if not data:
+                    break
+                now = time.perf_counter()
+                line = data.decode(errors='replace').rstrip('\r\n')
+                self.received.append((now, line))
+                for listener in self.listeners:
+                    listener(now, line)
+                parts = line.split(' ')
+                command = parts[0].upper()
+                if command == 'NICK' and len(parts) > 1:
+                    self.nick = parts[1].lstrip(':')
+                elif command == 'USER':
+                    user = True
+                elif command == 'CAP' and len(parts) > 1:
+                    negotiating = self.cap(parts[1].upper(), line.partition(' :')[2])
+                elif command == 'PING':
+                    self.send(f':{self.name} PONG {self.name} :{line.partition(" :")[2] or parts[-1]}')
+                elif command == 'PONG':
+                    future = self.pongs.pop(line.rpartition(':')[2], None)
+                    if future is not None and not future.done():
+                        future.set_result(now)
+                elif command == 'JOIN' and len(parts) > 1:
+                    for channel in parts[1].split(','):
+                        self.join(channel)
+                elif command == 'WHO' and len(parts) > 1:
+                    self.who(parts[1], len(parts) > 2)
+                elif command == 'MODE' and len(parts) == 3 and parts[2] in ('b', 'e', 'I'):
+                    end = {'b': '368', 'e': '349', 'I': '347'}[parts[2]]
+                    self.send(f':{self.name} {end} {self.nick} {parts[1]} :End of list')
+                elif command == 'QUIT':
+                    break
+                if command in ('NICK', 'USER', 'CAP') and user and self.nick and not negotiating \
+                        and not self.registered.is_set():
+                    self.welcome()
+        except OSError:
+            pass
+        finally:
+            if self.writer is writer:
+                self.drop()
+            else:
+                writer.close()
+
+    def cap(self, subcommand, names):
+        # True while registration waits for CAP END
+        if subcommand == 'LS':
+            self.send(f':{self.name} CAP * LS :{" ".join(sorted(self.caps))}')
+            return True
+        if subcommand == 'REQ':
+            wanted = set(names.split())
+            if wanted <= self.caps:
+                self.acked |= wanted
+                self.send(f':{self.name} CAP * ACK :{names}')
+            else:
+                self.send(f':{self.name} CAP * NAK :{names}')
+            return True
+        return False
+
+    def welcome(self):
+        self.send_lines([f':{self.name} 001 {self.nick} :Welcome to the benchmark network',
+                         f':{self.name} 005 {self.nick} {ISUPPORT} :are supported by this server',
+                         f':{self.name} 376 {self.nick} :End of MOTD'])
+        self.registered.set()
+
+    def join(self, channel):
+        self.channels.add(channel.lower())
+        if 'extended-join' in self.acked:
+            self.send(f':{self.nick}!bench@bench.host JOIN {channel} * :bench')
+        else:
+            self.send(f':{self.nick}!bench@bench.host JOIN {channel}')
+        self.joined.set()
+        if 'userhost-in-names' in self.acked:
+            # the bot has all it needs, it will not WHO
+            self.send_lines([f':{self.name} 353 {self.nick} = {channel} :@{self.nick}!bench@bench.host',
+                             f':{self.name} 366 {self.nick} {channel} :End of NAMES'])
+            self.whoed.set()
+
+    def who(self, channel, whox):
+        # the channel is empty but for the bot, which is opped
+        if whox:
+            self.send(f':{self.name} 354 {self.nick} 152 bench bench.host {self.nick} H@ 0')
+        else:
+            self.send(f':{self.name} 352 {self.nick} {channel} bench bench.host {self.name} {self.nick} H@ :0 bench')
+        self.send(f':{self.name} 315 {self.nick} {channel} :End of WHO')
+        self.whoed.set()
+
+
+async def serve(port, script, delay, caps):
+    ircd = FakeIRCd(caps=CAPS if caps else ())
+    await ircd.start('127.0.0.1', port)
+    print(f"Listening on 127.0.0.1:{port}")
+    while True:
+        await ircd.joined.wait()
+        if script:
+            with open(script, 'r', errors='replace') as f:
+                for line in f:
+                    ircd.send(line.rstrip('\r\n'))
+                    if delay:
+                        await ircd.drain()
+                        await asyncio.sleep(delay)
+            caught_up = await ircd.sync()
+            print(f"Script done, bot caught up at {caught_up:.3f}")
+        while ircd.writer is not None:
+            await asyncio.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake IRC server for protoGen benchmarks.')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--script', help='raw lines to send once the bot has joined')
+    parser.add_argument('--delay', type=float, default=0, help='seconds between script lines')
+    parser.add_argument('--caps', action='store_true', help='offer IRCv3 capabilities')
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.port, args.script, args.delay, args.caps))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""
+Load tests: runs protoGen against bench/fakeircd.py on localhost and reports
+lines/sec handled, JOIN-to-KICK and JOIN-to-OP latency percentiles, outbound
+lines per action and the bot's peak RSS for each scenario. Results can be
+saved as JSON and compared with an earlier run.
+
+Usage: python3 bench/loadtest.py [scenario ...] [--caps] [--json out.json] [--compare old.json]
+Scenarios: netjoin, joinflood, commands, fblarge, disconnect (default: all)
+With --caps the fake ircd offers the IRCv3 capabilities and a netjoin comes
+as a BATCH.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fakeircd import FakeIRCd, CAPS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROTOGEN = os.path.join(ROOT, 'protoGen.py')
+CHANNEL = '#bench'
+OWNER = 'owner!~owner@owner.bench'
+BOT_CONFIG = {
+    'server': '127.0.0.1',
+    'nick': 'bench',
+    'channel': CHANNEL,
+    # the token bucket would otherwise be all the test measures
+    'flood_rate': '100000',
+    'flood_burst': '100000',
+    'reconnect_delay': '0.05',
+}
+# the join lock is off by default
+SCENARIO_CONFIG = {'joinflood': {'flood_join': '8:4'}}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def latency_summary(values):
+    return {'count': len(values),
+            'p50_ms': ms(percentile(values, 50)),
+            'p90_ms': ms(percentile(values, 90)),
+            'p99_ms': ms(percentile(values, 99)),
+            'max_ms': ms(max(values) if values else None)}
+
+
+def ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+def peak_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class Actions:
+    # collects the KICKs, +o modes and everything else the bot sends, with
+    # the time each target was hit
+    def __init__(self, ircd):
+        self.kicked = {}
+        self.opped = {}
+        self.lines = 0
+        ircd.listeners.append(self.on_line)
+
+    def on_line(self, now, line):
+        parts = line.split(' ')
+        command = parts[0]
+        if command in ('PONG', 'PING'):
+            return
+        self.lines += 1
+        if command == 'KICK' and len(parts) > 2:
+            for nick in parts[2].split(','):
+                self.kicked.setdefault(nick, now)
+        elif command == 'MODE' and len(parts) > 3 and parts[2].startswith('+') and set(parts[2][1:]) == {'o'}:
+            for nick in parts[3:]:
+                self.opped.setdefault(nick, now)
+
+    async def wait(self, kicks, ops, timeout):
+        deadline = time.perf_counter() + timeout
+        while (len(self.kicked) < kicks or len(self.opped) < ops) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+
+
+async def send_timed(ircd, lines, chunk=500):
+    # sends lines in chunks and returns when each (nick) went out
+    sent = {}
+    for i in range(0, len(lines), chunk):
+        batch = lines[i:i + chunk]
+        now = time.perf_counter()
+        for line in batch:
+            sent[line.partition(':')[2].partition('!')[0]] = now
+        ircd.send_lines(batch)
+        await ircd.drain()
+    return sent
+
+
+def user_joins(count, prefix, bad_every=20, friend_every=20):
+    # every bad_every-th user matches the 'd' mask, the next one the 'f' mask
+    lines, bad, friends = [], [], []
+    for i in range(count):
+        nick = f'{prefix}{i}'
+        if i % bad_every == 0:
+            host = f'bad{i}.bench'
+            bad.append(nick)
+        elif i % friend_every == 1:
+            host = f'friend{i}.bench'
+            friends.append(nick)
+        else:
+            host = f'u{i}.users.bench'
+        lines.append(f':{nick}!~{nick}@{host} JOIN {CHANNEL}')
+    return lines, bad, friends
+
+
+def action_results(started, caught_up, count, sent, actions, bad, friends):
+    return {
+        'lines': count,
+        'lines_per_sec': round(count / (caught_up - started)),
+        'join_to_kick': latency_summary([actions.kicked[nick] - sent[nick] for nick in bad if nick in actions.kicked]),
+        'join_to_op': latency_summary([actions.opped[nick] - sent[nick] for nick in friends if nick in actions.opped]),
+        'outbound_lines': actions.lines,
+        'lines_per_action': round(actions.lines / max(1, len(actions.kicked) + len(actions.opped)), 3),
+    }
+
+
+FB_BASIC = [f'{CHANNEL} *!*@bad*.bench d', f'{CHANNEL} *!*@friend*.bench f']
+
+
+async def netjoin(ircd, options):
+    # a netsplit coming back: 10k users join in one burst
+    actions = Actions(ircd)
+    lines, bad, friends = user_joins(options.users, 'n')
+    if 'batch' in ircd.acked:
+        lines = [f'@batch=nj {line}' for line in lines]
+        ircd.send(f':{ircd.name} BATCH +nj netjoin irc.a irc.b')
+    started = time.perf_counter()
+    sent = await send_timed(ircd, lines)
+    if 'batch' in ircd.acked:
+        ircd.send(f':{ircd.name} BATCH -nj')
+    caught_up = await ircd.sync()
+    await actions.wait(len(bad), len(friends), 30)
+    return action_results(started, caught_up, len(lines), sent, actions, bad, friends)
+
+
+async def joinflood(ircd, options):
+    # join/part cycling from a different host every time
+    actions = Actions(ircd)
+    joins, bad, friends = user_joins(options.users // 2, 'f', bad_every=50, friend_every=50)
+    lines = []
+    for line in joins:
+        lines.append(line)
+        lines.append(line.replace(' JOIN ', ' PART ') + ' :cya')
+    started = time.perf_counter()
+    sent = await send_timed(ircd, lines)
+    caught_up = await ircd.sync()
+    await actions.wait(len(bad), 0, 10)
+    result = action_results(started, caught_up, len(lines), sent, actions, bad, [])
+    result['channel_locks'] = sum(1 for when, line in ircd.received if line.startswith(f'MODE {CHANNEL} +mi'))
+    return result
+
+
+async def commands(ircd, options):
+    # an owner firing .op commands, mixed with the same from strangers
+    actions = Actions(ircd)
+    count = options.users // 5
+    lines, sent = [], {}
+    for i in range(count):
+        lines.append(f':{OWNER} PRIVMSG {CHANNEL} :.op c{i}')
+        lines.append(f':x{i}!~x@x{i}.bench PRIVMSG {CHANNEL} :.op x{i}')
+    started = time.perf_counter()
+    for i in range(0, len(lines), 500):
+        now = time.perf_counter()
+        for j in range(i // 2, min(count, (i + 500) // 2)):
+            sent[f'c{j}'] = now
+        ircd.send_lines(lines[i:i + 500])
+        await ircd.drain()
+    caught_up = await ircd.sync()
+    await actions.wait(0, count, 20)
+    return {
+        'lines': len(lines),
+        'lines_per_sec': round(len(lines) / (caught_up - started)),
+        'command_to_mode': latency_summary([actions.opped[nick] - sent[nick] for nick in sent if nick in actions.opped]),
+        'stranger_ops': sum(1 for nick in actions.opped if nick.startswith('x')),
+        'outbound_lines': actions.lines,
+    }
+
+
+async def fblarge(ircd, options):
+    # the netjoin against 50k fb masks, most of them exact hosts
+    return await netjoin(ircd, options)
+
+
+def fblarge_entries(options):
+    entries = [f'{CHANNEL} *!*@h{i}.big.bench d' for i in range(options.masks)]
+    entries += [f'{CHANNEL} *!*ident{i}@*.wild.bench d' for i in range(100)]
+    return entries + FB_BASIC
+
+
+async def disconnect(ircd, options):
+    # forced disconnects, timed until the bot is back on the channel
+    times = []
+    for _ in range(options.drops):
+        await asyncio.sleep(0.2)
+        dropped = time.perf_counter()
+        ircd.drop()
+        await asyncio.wait_for(ircd.joined.wait(), 30)
+        times.append(time.perf_counter() - dropped)
+    return {'drops': options.drops, 'connections': ircd.connections, 'rejoin': latency_summary(times)}
+
+
+SCENARIOS = {
+    'netjoin': (netjoin, lambda options: FB_BASIC),
+    'joinflood': (joinflood, lambda options: FB_BASIC),
+    'commands': (commands, lambda options: FB_BASIC),
+    'fblarge': (fblarge, fblarge_entries),
+    'disconnect': (disconnect, lambda options: FB_BASIC),
+}
+
+
+async def run_scenario(name, options):
+    func, fb_entries = SCENARIOS[name]
+    ircd = FakeIRCd(caps=CAPS if options.caps else ())
+    port = await ircd.start()
+    with tempfile.TemporaryDirectory(prefix='protogen-bench-') as directory:
+        config = dict(BOT_CONFIG, port=str(port), **SCENARIO_CONFIG.get(name, {}))
+        with open(os.path.join(directory, 'config.txt'), 'w') as f:
+            f.writelines(f'{key}={value}\n' for key, value in config.items())
+        with open(os.path.join(directory, 'owner.txt'), 'w') as f:
+            f.write('*!~owner@owner.bench\n')
+        with open(os.path.join(directory, 'fb.txt'), 'w') as f:
+            f.writelines(entry + '\n' for entry in fb_entries(options))
+        started = time.perf_counter()
+        bot = await asyncio.create_subprocess_exec(sys.executable, PROTOGEN, cwd=directory,
+                                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await asyncio.wait_for(ircd.whoed.wait(), 60)
+            result = {'startup_ms': ms(time.perf_counter() - started)}
+            # the bot has its ops once it is through the WHO reply
+            await ircd.sync()
+            result.update(await func(ircd, options))
+            result['peak_rss_kb'] = peak_rss_kb(bot.pid)
+        finally:
+            if bot.returncode is None:
+                bot.terminate()
+            await bot.wait()
+            await ircd.stop()
+    return result
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(result, prefix=''):
+    for key, value in result.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + '.')
+        else:
+            yield prefix + key, value
+
+
+def report(name, result, baseline=None):
+    print(name)
+    old = dict(flatten(baseline)) if baseline else {}
+    for key, value in flatten(result):
+        line = f"  {key:28} {value}"
+        if isinstance(value, (int, float)) and isinstance(old.get(key), (int, float)) and old[key]:
+            line += f"  ({(value - old[key]) / old[key] * 100:+.1f}% vs {old[key]})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='protoGen load tests against a local fake ircd.')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default: all)')
+    parser.add_argument('--users', type=int, default=10000, help='users per netjoin (default 10000)')
+    parser.add_argument('--masks', type=int, default=50000, help='fb masks for fblarge (default 50000)')
+    parser.add_argument('--drops', type=int, default=5, help='forced disconnects (default 5)')
+    parser.add_argument('--caps', action='store_true', help='offer the IRCv3 capabilities')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run to compare with')
+    options = parser.parse_args()
+    for name in options.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f).get('results', {})
+    results = {}
+    for name in options.scenarios or SCENARIOS:
+        results[name] = asyncio.run(run_scenario(name, options))
+        report(name, results[name], baseline.get(name))
+    if options.json:
+        with open(options.json, 'w') as f:
+            json.dump({'version': git_version(), 'python': platform.python_version(),
+                       'time': int(time.time()), 'options': vars(options), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
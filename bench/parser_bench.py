@@ -0,0 +1,88 @@
+"""
+Micro-benchmark: lines/sec of protoGen's Message parser compared with the
+substring and split() handling the bot used before it.
+
+Usage: python3 bench/parser_bench.py [lines]
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from protoGen import parse_message
+
+
+def sample_lines(count):
+    lines = []
+    for i in range(count):
+        kind = i % 5
+        if kind == 0:
+            lines.append(f':nick{i}!~ident{i}@host{i}.example.net JOIN :#channel')
+        elif kind == 1:
+            lines.append(f':nick{i}!~ident{i}@host{i}.example.net PRIVMSG #channel :hello there, how is it going?')
+        elif kind == 2:
+            lines.append(f':irc.example.net 352 bot #channel ~ident{i} host{i}.example.net irc.example.net nick{i} H :0 Real Name')
+        elif kind == 3:
+            lines.append(f'@time=2024-01-01T00:00:00.000Z;account=acc{i} :nick{i}!ident@host.example.net MODE #channel +o nick{i + 1}')
+        else:
+            lines.append('PING :irc.example.net')
+    return lines
+
+
+def legacy(lines):
+    # what main() did with every line before the parser
+    for message in lines:
+        if message.startswith('PING'):
+            message.split()[1]
+        elif 'JOIN' in message:
+            sender = message.split('!')[0][1:] + '!' + message.split('!')[1].split()[0]
+            channel = message.split('JOIN ')[1].strip()
+        elif re.search(r'PRIVMSG', message):
+            sender = message.split('!')[0][1:] + '!' + message.split('!')[1].split()[0]
+            command = message.split('PRIVMSG')[1].strip().split(' :')[1]
+        elif '352' in message:
+            parts = message.split()
+            if len(parts) > 7:
+                nick = parts[7]
+                ident_host = parts[4] + '@' + parts[5]
+
+
+def parsed(lines):
+    for line in lines:
+        msg = parse_message(line)
+        command = msg.command
+        if command == 'PING':
+            msg.params[0]
+        elif command == 'JOIN':
+            sender = msg.prefix
+            channel = msg.params[0]
+        elif command == 'PRIVMSG':
+            sender = msg.prefix
+            text = msg.params[1]
+        elif command == '352':
+            nick = msg.params[5]
+            ident_host = msg.params[2] + '@' + msg.params[3]
+
+
+def measure(func, lines, rounds=5):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func(lines)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    lines = sample_lines(count)
+    old = measure(legacy, lines)
+    new = measure(parsed, lines)
+    print(f"legacy string handling: {old:12,.0f} lines/sec")
+    print(f"parse_message:          {new:12,.0f} lines/sec ({new / old:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
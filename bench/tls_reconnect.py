@@ -0,0 +1,86 @@
+"""
+Reconnect latency over TLS with and without session resumption, measured
+against a local TLS server that uses a throwaway self-signed certificate
+made with the openssl command line tool.
+
+Usage: python3 bench/tls_reconnect.py [connections]
+"""
+import asyncio
+import os
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from protoGen import tls_context
+
+
+def make_certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-keyout', key, '-out', cert, '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+async def handle(reader, writer):
+    writer.write(b':localhost 001 bench :Welcome\r\n')
+    await writer.drain()
+    await reader.read()
+    writer.close()
+
+
+async def reconnect(context, port):
+    # connect until the first line (the 001) is in, like a reconnect
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection('localhost', port, ssl=context)
+    await reader.readline()
+    elapsed = time.perf_counter() - start
+    ssl_object = writer.get_extra_info('ssl_object')
+    context.sessions['localhost'] = ssl_object.session
+    reused = ssl_object.session_reused
+    writer.close()
+    await writer.wait_closed()
+    return elapsed, reused
+
+
+async def measure(context, port, count, resume):
+    times, reused = [], 0
+    for _ in range(count):
+        if not resume:
+            context.sessions.clear()
+        elapsed, was_reused = await reconnect(context, port)
+        times.append(elapsed)
+        reused += was_reused
+    return times, reused
+
+
+async def run(count):
+    with tempfile.TemporaryDirectory() as directory:
+        cert, key = make_certificate(directory)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+        server = await asyncio.start_server(handle, 'localhost', 0, ssl=server_context)
+        port = server.sockets[0].getsockname()[1]
+        context = tls_context({'tls': '1', 'tls_ca': cert})
+        async with server:
+            await reconnect(context, port)  # warm up
+            for name, resume in (('full handshake', False), ('resumed session', True)):
+                times, reused = await measure(context, port, count, resume)
+                print(f"{name:16} median {statistics.median(times) * 1000:7.2f} ms  "
+                      f"p95 {sorted(times)[int(len(times) * 0.95) - 1] * 1000:7.2f} ms  "
+                      f"reused {reused}/{count}")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    asyncio.run(run(count))
+
+
+if __name__ == '__main__':
+    main()
@@ -38,10 +38,45 @@ file and their descriptions.
 
 """
 import os
+import sys
 import socket
+import ssl
+import base64
+import asyncio
+import json
+import hmac
+import hashlib
 import re
 import time
+import random
 import argparse
+import functools
+import heapq
+import bisect
+import gzip
+import shutil
+import threading
+import tempfile
+import difflib
+import queue
+import logging
+import logging.handlers
+import importlib.util
+import ctypes
+import ctypes.util
+import struct
+import errno
+import contextlib
+from collections import deque, OrderedDict
+
+# Log categories, see setup_logging()
+log = logging.getLogger('protoGen.bot')
+log_conn = logging.getLogger('protoGen.conn')
+log_raw = logging.getLogger('protoGen.raw')
+log_action = logging.getLogger('protoGen.action')
+log_command = logging.getLogger('protoGen.command')
+log_link = logging.getLogger('protoGen.link')
+LOG_CATEGORIES = ('bot', 'conn', 'raw', 'action', 'command', 'link')
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Bot configuration.')
@@ -51,10 +86,52 @@ def parse_arguments():
     parser.add_argument('-n', '--nick', help='Bot nickname', type=str)
     parser.add_argument('-c', '--channel', help='Channel to join after connect (use double quotes around channel name, e.g., "#channel")', type=str)
     parser.add_argument('-o', '--owner', help='First bot owner in format \'*!ident@host\'', type=str)
-    
+
+    subparsers = parser.add_subparsers(dest='command')
+    fb_import = subparsers.add_parser('fb-import', help='Import fb entries from a file (one "#channel *!ident@host flag [network]" per line)')
+    fb_import.add_argument('file', help='File to import, - for stdin')
+    fb_import.add_argument('--channel', dest='fb_channel', help='Channel for lines that only contain a mask')
+    fb_import.add_argument('--flag', dest='fb_flag', choices=FB_FLAGS, help='Flag for lines that only contain a mask')
+    fb_import.add_argument('--network', dest='fb_network', default='', help='Network for lines without one (default: every network)')
+    fb_export = subparsers.add_parser('fb-export', help='Export fb entries')
+    fb_export.add_argument('file', nargs='?', default='-', help='File to write, - for stdout (default)')
+    fb_export.add_argument('--channel', dest='fb_channel', help='Only export this channel')
+    fb_export.add_argument('--network', dest='fb_network', help='Only export entries of this network')
+    replay = subparsers.add_parser('replay', help='Feed a traffic capture (capture= in config.txt) through the bot offline')
+    replay.add_argument('files', nargs='+', help='Capture files in order, .gz ones are read as well')
+    replay.add_argument('--network', help='Network to replay (default: the first one in the capture)')
+    replay.add_argument('--speed', type=float, default=0, help='0 replays as fast as possible on the captured clock, 1 at the recorded speed, 2 twice as fast (default 0)')
+    replay.add_argument('--actions', help='Write the lines the bot sent to this file')
+    replay.add_argument('--expect', help='Compare the lines the bot sent with an earlier --actions file')
+    replay.add_argument('--profile', help='Run under cProfile and save the stats to this file')
+    replay.add_argument('--tracemalloc', type=int, default=0, metavar='FRAMES', help='Trace allocations with this many frames')
+    replay.add_argument('--verbose', action='store_true', help='Show the bot output')
+
     return parser.parse_args()
 
 
+def run_command(args):
+    # command line subcommands that work on the lists without connecting
+    if args.command == 'replay':
+        replay(args)
+        return
+    fb = FbList()
+    try:
+        if args.command == 'fb-import':
+            f = sys.stdin if args.file == '-' else open(args.file, 'r', errors='replace')
+            with f:
+                added, duplicates, invalid = import_fb(fb, f, args.fb_channel, args.fb_flag, args.fb_network)
+            print(f"Imported {len(added)} fb entries ({duplicates} duplicates, {invalid} invalid).")
+        elif args.command == 'fb-export':
+            f = sys.stdout if args.file == '-' else open(args.file, 'w')
+            for line in export_fb(fb, args.fb_channel, args.fb_network):
+                f.write(line + '\n')
+            if f is not sys.stdout:
+                f.close()
+    finally:
+        fb.close()
+
+
 class ConfigWizard:
     def __init__(self):
         self.config = {}
@@ -91,64 +168,815 @@ class ConfigWizard:
         self.ask_bind_ip()
 
 
-def add_owner(owner):
-    with open('owner.txt', 'a') as f:
-        f.write(owner + '\n')
-
-def remove_owner(owner):
-    with open('owner.txt', 'r') as f:
-        lines = f.readlines()
-    with open('owner.txt', 'w') as f:
-        for line in lines:
-            if line.strip() != owner:
-                f.write(line)
+OWNER_MASK = re.compile(r'^\*\![^@\s]+\@[^@\s]+$')
 
-def list_owners():
-    with open('owner.txt', 'r') as f:
-        owners = [line.strip() for line in f.readlines()]
-    return owners
 
 def handle_owner_command(command, sender, owners):
     if command.startswith('.+own '):
         owner = command.split(' ')[1]
-        if re.match(r'^\*\![^@]+\@[^@]+$', owner) and owner not in list_owners():
-            add_owner(owner)
-            owners.append(r"{}".format(owner.replace('*', '.*')))  # Update the owners list
+        if OWNER_MASK.fullmatch(owner) and owners.add((owner,)):
             return f"{owner} added to the owner list."
         else:
             return f"Invalid owner format or owner already exists."
     elif command.startswith('.-own '):
         owner = command.split(' ')[1]
-        if owner in list_owners():
-            remove_owner(owner)
-            owner_pattern = r"{}".format(owner.replace('*', '.*'))
-            if owner_pattern in owners:
-                owners.remove(owner_pattern)  # Update the owners list
+        if owners.remove((owner,)):
             return f"{owner} removed from the owner list."
         else:
             return f"Owner not found in the owner list."
     elif command == '.own':
-        owners = list_owners()
-        if owners:
-            return f"Current owners: {', '.join(owners)}"
+        masks = owners.masks()
+        if masks:
+            return f"Current owners: {', '.join(masks)}"
         else:
             return "No owners found."
     else:
         return "Invalid owner command."        
 
+RFC1459_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\~', 'abcdefghijklmnopqrstuvwxyz{}|^')
+
+
+WILDCARDS = re.compile(r'[*?]')
+
+
+@functools.lru_cache(maxsize=65536)
+def compile_mask(mask):
+    # IRC wildcard mask -> match function, '*' is any run and '?' any single
+    # character, everything else is literal. Expects an already lowercased
+    # mask. Masks with only '*' are matched with plain string operations,
+    # which is much cheaper to build than a regex for big lists.
+    mask = re.sub(r'\*+', '*', mask)
+    if '?' in mask:
+        pattern = ''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in mask)
+        regex = re.compile(pattern + r'\Z', re.DOTALL)
+        return lambda text: regex.match(text) is not None
+    if '*' not in mask:
+        return mask.__eq__
+    parts = mask.split('*')
+    first, middle, last = parts[0], parts[1:-1], parts[-1]
+    minimum = sum(map(len, parts))
+
+    def match(text):
+        if len(text) < minimum or not text.startswith(first) or not text.endswith(last):
+            return False
+        pos, end = len(first), len(text) - len(last)
+        for part in middle:
+            pos = text.find(part, pos, end)
+            if pos < 0:
+                return False
+            pos += len(part)
+        return True
+    return match
+
+
+def mask_match(mask, hostmask, lower=RFC1459_LOWER):
+    return compile_mask(mask.translate(lower))(hostmask.translate(lower))
+
+
+def split_hostmask(hostmask):
+    nick, _, rest = hostmask.partition('!')
+    user, _, host = rest.partition('@')
+    return nick, user, host
+
+
+class MaskIndex:
+    # Wildcard masks (nick!user@host), each with a value. Every mask is
+    # compiled once and filed under a literal part of it: the exact host, a
+    # '.domain' suffix, an 'a.b.' address prefix, the literal tail of the
+    # ident or the exact nick. A lookup only tries the masks filed under keys
+    # the hostmask can produce. Results are cached per nick!user@host until
+    # the masks change.
+    def __init__(self, lower=RFC1459_LOWER, cache_size=8192):
+        self.lower = lower
+        self.cache_size = cache_size
+        self.entries = {}
+        self.exact = {}
+        self.suffixes = {}
+        self.prefixes = {}
+        self.idents = {}
+        self.nicks = {}
+        self.generic = {}
+        self.cache = OrderedDict()
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, entry):
+        return entry in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def bucket(self, mask):
+        nick, user, host = split_hostmask(mask)
+        if host and not WILDCARDS.search(host):
+            return self.exact, host
+        parts = WILDCARDS.split(host)
+        head, tail = parts[0], parts[-1]
+        if '.' in tail:
+            return self.suffixes, tail[tail.index('.'):]
+        if '.' in head:
+            return self.prefixes, head[:head.rindex('.') + 1]
+        tail = WILDCARDS.split(user)[-1]
+        if tail:
+            return self.idents, tail
+        if nick and not WILDCARDS.search(nick):
+            return self.nicks, nick
+        return self.generic, None
+
+    def add(self, mask, value=None):
+        if not self.insert(mask, value):
+            return False
+        self.cache.clear()
+        return True
+
+    def add_many(self, items):
+        # bulk load, the cache is dropped once at the end
+        added = sum(1 for mask, value in items if self.insert(mask, value))
+        self.cache.clear()
+        return added
+
+    def insert(self, mask, value):
+        entry = (mask, value)
+        if entry in self.entries:
+            return False
+        lowered = mask.translate(self.lower)
+        self.seq += 1
+        self.entries[entry] = (self.seq, compile_mask(lowered))
+        table, key = self.bucket(lowered)
+        if key is None:
+            self.generic[entry] = True
+        else:
+            table.setdefault(key, {})[entry] = True
+        return True
+
+    def remove(self, mask, value=None):
+        entry = (mask, value)
+        if self.entries.pop(entry, None) is None:
+            return False
+        table, key = self.bucket(mask.translate(self.lower))
+        if key is None:
+            self.generic.pop(entry, None)
+        else:
+            bucket = table.get(key, {})
+            bucket.pop(entry, None)
+            if not bucket:
+                table.pop(key, None)
+        self.cache.clear()
+        return True
+
+    def clear(self):
+        for table in (self.entries, self.exact, self.suffixes, self.prefixes, self.idents,
+                      self.nicks, self.generic, self.cache):
+            table.clear()
+
+    def candidates(self, nick, user, host):
+        bucket = self.exact.get(host)
+        if bucket:
+            yield from bucket
+        dot = host.find('.')
+        while dot >= 0:
+            bucket = self.suffixes.get(host[dot:])
+            if bucket:
+                yield from bucket
+            bucket = self.prefixes.get(host[:dot + 1])
+            if bucket:
+                yield from bucket
+            dot = host.find('.', dot + 1)
+        idents = self.idents
+        for i in range(len(user)):
+            bucket = idents.get(user[i:])
+            if bucket:
+                yield from bucket
+        bucket = self.nicks.get(nick)
+        if bucket:
+            yield from bucket
+        yield from self.generic
+
+    def match(self, hostmask):
+        # all (mask, value) entries matching nick!user@host, oldest first
+        hostmask = hostmask.translate(self.lower)
+        cached = self.cache.get(hostmask)
+        if cached is not None:
+            self.cache.move_to_end(hostmask)
+            return cached
+        nick, user, host = split_hostmask(hostmask)
+        found = []
+        entries = self.entries
+        for entry in self.candidates(nick, user, host):
+            seq, matcher = entries[entry]
+            if matcher(hostmask):
+                found.append((seq, entry))
+        found.sort()
+        result = tuple(entry for seq, entry in found)
+        self.cache[hostmask] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+
 def is_owner(sender, owners):
-    return any(re.search(owner, sender) for owner in owners)
-
-def extract_nick_from_whois(response):
-    for line in response.split('\n'):
-        if line.startswith(':') and '311' in line:
-            parts = line.split()
-            if len(parts) > 3:
-                # Use regular expression to extract nick from WHOIS response
-                m = re.search(r'^.*is\s+([^\s]+)', line)
-                if m:
-                    return m.group(1)
-    return None
+    return bool(owners.match(sender))
+
+
+def file_signature(path):
+    # changes whenever the file is written or replaced
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class JournaledList:
+    # Entries kept in memory and stored as a plain text snapshot (owner.txt,
+    # fb.txt) plus an append-only journal next to it. An add or remove is one
+    # line appended to the journal and fsynced. The journal is folded back
+    # into the snapshot at startup and whenever it grows past compact_after
+    # lines; the snapshot is written to a temporary file and renamed over
+    # the old one, so a crash never leaves a half-written file behind.
+    # Replaying an add or remove twice changes nothing, a crash between the
+    # rename and the journal reset is harmless. Bulk adds, and everything
+    # done inside transaction(), are written as one begin ... commit block
+    # with a single fsync and only replayed if the commit made it to disk.
+    # While the event loop runs the snapshot is written by a background
+    # thread, the journal lines logged meanwhile are kept for the new
+    # journal.
+    compact_after = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.entries = {}
+        self.comments = []
+        self.journal = None
+        self.journal_lines = 0
+        # what the journal changed since the last compact, and the snapshot
+        # as we last wrote it, for reload()
+        self.pending = {}
+        self.signature = None
+        self.batch = None
+        # the background compact: its thread, and the journal lines and
+        # pending changes since its snapshot
+        self.compacting = None
+        self.tail = None
+        self.tail_pending = None
+        self.load()
+
+    def parse(self, line):
+        raise NotImplementedError
+
+    def format(self, entry):
+        return ' '.join(entry)
+
+    def added(self, entry):
+        pass
+
+    def added_many(self, entries):
+        for entry in entries:
+            self.added(entry)
+
+    def removed(self, entry):
+        pass
+
+    def __contains__(self, entry):
+        return entry in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        if os.path.isfile(self.path):
+            with open(self.path, 'r', errors='replace') as f:
+                for line in f:
+                    line = line.strip()
+                    entry = self.parse(line)
+                    if entry is None:
+                        if line:
+                            self.comments.append(line)
+                    elif entry not in self.entries:
+                        self.entries[entry] = None
+                        self.added(entry)
+        # a missing journal means the snapshot was never written by us, it is
+        # rewritten below so hand-made files get normalised once
+        fresh = not os.path.isfile(self.journal_path)
+        if not fresh:
+            batch = None
+            with open(self.journal_path, 'r', errors='replace') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # torn write from a crash
+                    op, _, rest = line.rstrip('\n').partition(' ')
+                    if op == 'begin':
+                        batch = []
+                        continue
+                    if op == 'commit':
+                        for op, entry in batch or ():
+                            if op == '+':
+                                self.apply_add(entry)
+                            else:
+                                self.apply_remove(entry)
+                        batch = None
+                        continue
+                    entry = self.parse(rest)
+                    if entry is None:
+                        continue
+                    if batch is not None:
+                        batch.append((op, entry))
+                    elif op == '+':
+                        self.apply_add(entry)
+                    elif op == '-':
+                        self.apply_remove(entry)
+                    self.journal_lines += 1
+        if fresh or self.journal_lines:
+            self.compact()
+        else:
+            self.journal = open(self.journal_path, 'a')
+            self.signature = file_signature(self.path)
+
+    def reload(self):
+        # The snapshot was changed by someone else: read it again and apply
+        # only the difference, the index follows through added()/removed().
+        # Changes journaled since the last compact are not in the file yet
+        # and win over it; the journal is kept, so the file as edited plus
+        # the journal is still what is in memory and the file is left as it
+        # is. Returns (added, removed).
+        entries = {}
+        comments = []
+        signature = file_signature(self.path)
+        with open(self.path, 'r', errors='replace') as f:
+            for line in f:
+                line = line.strip()
+                entry = self.parse(line)
+                if entry is None:
+                    if line:
+                        comments.append(line)
+                else:
+                    entries[entry] = None
+        pending = self.pending
+        removed = [entry for entry in self.entries if entry not in entries and pending.get(entry) != '+']
+        added = [entry for entry in entries if entry not in self.entries and pending.get(entry) != '-']
+        for entry in removed:
+            self.apply_remove(entry)
+        for entry in added:
+            self.entries[entry] = None
+        self.added_many(added)
+        self.comments = comments
+        self.signature = signature
+        return added, removed
+
+    def apply_add(self, entry):
+        if entry in self.entries:
+            return False
+        self.entries[entry] = None
+        self.added(entry)
+        return True
+
+    def apply_remove(self, entry):
+        if entry not in self.entries:
+            return False
+        del self.entries[entry]
+        self.removed(entry)
+        return True
+
+    def add(self, entry):
+        if not self.apply_add(entry):
+            return False
+        self.log('+', entry)
+        return True
+
+    def remove(self, entry):
+        if not self.apply_remove(entry):
+            return False
+        self.log('-', entry)
+        return True
+
+    def add_many(self, entries):
+        # Adds everything that is new in one journal transaction and returns
+        # the entries that were actually added.
+        new = [entry for entry in dict.fromkeys(entries) if entry not in self.entries]
+        if not new:
+            return new
+        with self.transaction():
+            for entry in new:
+                self.entries[entry] = None
+                self.log('+', entry)
+        self.added_many(new)
+        return new
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # group commit, the changes made inside hit the disk together
+        if self.batch is not None:
+            yield
+            return
+        self.batch = []
+        try:
+            yield
+        finally:
+            lines, self.batch = self.batch, None
+            if lines:
+                self.write_journal(lines)
+
+    def log(self, op, entry):
+        self.pending[entry] = op
+        if self.tail_pending is not None:
+            self.tail_pending[entry] = op
+        line = f"{op} {self.format(entry)}\n"
+        if self.batch is not None:
+            self.batch.append(line)
+        else:
+            self.write_journal([line])
+
+    def write_journal(self, lines):
+        block = lines[0] if len(lines) == 1 else 'begin\n' + ''.join(lines) + 'commit\n'
+        self.journal.write(block)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_lines += len(lines)
+        if self.tail is not None:
+            self.tail.append((block, len(lines)))
+        if self.journal_lines >= self.compact_after and self.compacting is None:
+            self.compact_soon()
+
+    def snapshot(self):
+        return ''.join(line + '\n' for line in self.comments) + \
+            ''.join(self.format(entry) + '\n' for entry in self.entries)
+
+    def write_snapshot(self, text):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return file_signature(self.path)
+
+    def compact_soon(self):
+        # compact() without blocking the event loop, outside of it the same
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.compact()
+            return
+        self.tail, self.tail_pending = [], {}
+        self.compacting = threading.Thread(target=self.compact_thread, args=(self.snapshot(), loop), daemon=True)
+        self.compacting.start()
+
+    def compact_thread(self, text, loop):
+        try:
+            result = self.write_snapshot(text)
+        except OSError as e:
+            result = e
+        try:
+            loop.call_soon_threadsafe(self.compacted, threading.current_thread(), result)
+        except RuntimeError:
+            pass  # the loop is gone, close() compacts
+
+    def compacted(self, thread, result):
+        if self.compacting is not thread:
+            return
+        tail, pending = self.tail, self.tail_pending
+        self.compacting = self.tail = self.tail_pending = None
+        if isinstance(result, OSError):
+            log.error(f"Unable to compact {self.path}: {result}")
+            return
+        self.signature = result
+        # the snapshot has everything up to the copy, the new journal keeps
+        # what came after it
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(''.join(block for block, count in tail))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+        self.journal.close()
+        self.journal = open(self.journal_path, 'a')
+        self.journal_lines = sum(count for block, count in tail)
+        self.pending = pending
+
+    def compact(self):
+        self.signature = self.write_snapshot(self.snapshot())
+        if self.journal is not None:
+            self.journal.close()
+        self.journal = open(self.journal_path, 'w')
+        self.journal_lines = 0
+        self.pending.clear()
+
+    def close(self):
+        if self.compacting is not None:
+            self.compacting.join()
+            self.compacting = self.tail = self.tail_pending = None
+        if self.journal is not None:
+            if self.journal_lines:
+                self.compact()
+            self.journal.close()
+            self.journal = None
+
+
+class OwnerList(JournaledList):
+    # owner.txt, one *!ident@host mask per line
+    def __init__(self, path='owner.txt'):
+        self.index = MaskIndex()
+        super().__init__(path)
+
+    def parse(self, line):
+        if not line or line.startswith('#') or ' ' in line:
+            return None
+        return (line,)
+
+    def added(self, entry):
+        self.index.add(entry[0])
+
+    def removed(self, entry):
+        self.index.remove(entry[0])
+
+    def match(self, sender):
+        return self.index.match(sender)
+
+    def masks(self):
+        return [entry[0] for entry in self.entries]
+
+
+class FbList(JournaledList):
+    # fb.txt, '#channel *!ident@host flag [network]' per line. Entries without
+    # a network apply on every network. One mask index per (network,
+    # lowercased channel) pair, '' being the network of the shared entries.
+    def __init__(self, path='fb.txt'):
+        self.index = {}
+        super().__init__(path)
+
+    def parse(self, line):
+        fields = line.split()
+        if len(fields) not in (3, 4) or not fields[0].startswith('#'):
+            return None
+        if len(fields) == 3:
+            fields.append('')
+        return tuple(fields)
+
+    def format(self, entry):
+        return ' '.join(field for field in entry if field)
+
+    def key(self, network, channel):
+        return network, channel.translate(RFC1459_LOWER)
+
+    def lookup(self, network, channel):
+        # the indexes that apply to channel on network, its own entries first
+        indexes = []
+        for key in (self.key(network, channel), self.key('', channel)):
+            index = self.index.get(key)
+            if index and index not in indexes:
+                indexes.append(index)
+        return indexes
+
+    def added(self, entry):
+        channel, host, flag, network = entry
+        key = self.key(network, channel)
+        if key not in self.index:
+            self.index[key] = MaskIndex()
+        self.index[key].add(host, flag)
+
+    def added_many(self, entries):
+        by_channel = {}
+        for channel, host, flag, network in entries:
+            by_channel.setdefault(self.key(network, channel), []).append((host, flag))
+        for key, items in by_channel.items():
+            if key not in self.index:
+                self.index[key] = MaskIndex()
+            self.index[key].add_many(items)
+
+    def removed(self, entry):
+        channel, host, flag, network = entry
+        key = self.key(network, channel)
+        index = self.index.get(key)
+        if index is not None:
+            index.remove(host, flag)
+            if not index:
+                del self.index[key]
+
+class TimerList(JournaledList):
+    # timers.txt, 'due action network channel target extra' per line, due
+    # being a unix timestamp and '*' standing for no network. The entries
+    # are also indexed by what they act on, for find().
+    def __init__(self, path='timers.txt'):
+        self.index = {}
+        super().__init__(path)
+
+    def parse(self, line):
+        fields = line.split()
+        if len(fields) != 6 or not fields[0].isdigit():
+            return None
+        return tuple(fields)
+
+    def key(self, action, network, channel, target):
+        return action, network or '*', channel.translate(RFC1459_LOWER), target
+
+    def added(self, entry):
+        self.index.setdefault(self.key(*entry[1:5]), []).append(entry)
+
+    def removed(self, entry):
+        key = self.key(*entry[1:5])
+        entries = self.index.get(key)
+        if entries is not None:
+            entries.remove(entry)
+            if not entries:
+                del self.index[key]
+
+    def find(self, action, network, channel, target):
+        return list(self.index.get(self.key(action, network, channel, target), ()))
+
+
+class Timer:
+    # an in-memory timer from Scheduler.call_later()
+    __slots__ = ('callback', 'args', 'cancelled')
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    # Timed actions in one heap ordered by due time, with a single event loop
+    # timer armed for the earliest of them. Persistent timers (timed bans, fb
+    # expiry) are TimerList entries and survive a restart, call_later() ones
+    # only live in memory. Cancelling only drops the entry, its heap item is
+    # skipped when it comes up and the heap is rebuilt once most of it is
+    # stale, so adding and cancelling stay O(log n) with 100k timers.
+    def __init__(self, bot, timers):
+        self.bot = bot
+        self.clock = bot.clock
+        self.timers = timers
+        self.seq = 0
+        self.heap = []
+        for entry in timers:
+            self.seq += 1
+            self.heap.append((int(entry[0]), self.seq, entry))
+        heapq.heapify(self.heap)
+        self.stale = 0
+        self.handle = None
+
+    def __len__(self):
+        return len(self.heap) - self.stale
+
+    def start(self):
+        self.arm()
+
+    def schedule(self, delay, action, network, channel, target, extra='-'):
+        entry = (str(int(self.clock.time() + delay)), action, network or '*', channel, target, extra)
+        if self.timers.add(entry):
+            self.push(int(entry[0]), entry)
+        return entry
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(callback, args)
+        self.push(self.clock.time() + delay, timer)
+        return timer
+
+    def cancel(self, entry):
+        if self.timers.remove(entry):
+            self.stale += 1
+            if self.stale > 1024 and self.stale > len(self.heap) // 2:
+                self.heap = [item for item in self.heap if self.pending(item[2])]
+                heapq.heapify(self.heap)
+                self.stale = 0
+            return True
+        return False
+
+    def find(self, action, network, channel, target):
+        # the pending persistent timers for one thing, e.g. a ban mask
+        return self.timers.find(action, network, channel, target)
+
+    def transaction(self):
+        # schedules and cancels inside share one journal write
+        return self.timers.transaction()
+
+    def pending(self, item):
+        if isinstance(item, Timer):
+            return not item.cancelled
+        return item in self.timers
+
+    def push(self, due, item):
+        self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, item))
+        if self.heap[0][2] is item:
+            self.arm()
+
+    def arm(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        while self.heap and not self.pending(self.heap[0][2]):
+            heapq.heappop(self.heap)
+            self.stale = max(0, self.stale - 1)
+        if self.heap:
+            delay = max(0, self.heap[0][0] - self.clock.time())
+            self.handle = asyncio.get_running_loop().call_later(delay, self.run_due)
+
+    def run_due(self):
+        self.handle = None
+        now = self.clock.time()
+        with self.transaction():
+            self.run_until(now)
+        self.arm()
+
+    def run_until(self, now):
+        while self.heap and self.heap[0][0] <= now:
+            due, seq, item = heapq.heappop(self.heap)
+            try:
+                if isinstance(item, Timer):
+                    if not item.cancelled:
+                        item.callback(*item.args)
+                elif item in self.timers:
+                    self.timers.remove(item)
+                    self.fire(item)
+                else:
+                    self.stale = max(0, self.stale - 1)
+            except Exception as e:
+                log.error(f"Timer failed: {e!r}")
+
+    def fire(self, entry):
+        due, action, network, channel, target, extra = entry
+        handler = TIMER_ACTIONS.get(action)
+        if handler is not None:
+            handler(self.bot, '' if network == '*' else network, channel, target, extra)
+
+
+def timer_unban(bot, network, channel, mask, extra):
+    # the ban stays and is retried in a minute while the bot cannot remove it
+    conn = bot.connections.get(network)
+    if conn is None:
+        return
+    if conn.writer is None or not bot_is_op(conn, channel):
+        bot.scheduler.schedule(60, 'unban', network, channel, mask)
+        return
+    for line in unban_lines(conn, channel, [mask]):
+        conn.send(line)
+
+
+def timer_fb_expire(bot, network, channel, host, flag):
+    remove_fb(bot, channel, host, flag, network)
+
+
+def timer_unlock(bot, network, channel, modes, extra):
+    # lifts a flood lock, retried like a timed ban
+    conn = bot.connections.get(network)
+    if conn is None or not conn.state.channel(channel):
+        return
+    if conn.writer is None or not bot_is_op(conn, channel):
+        bot.scheduler.schedule(60, 'unlock', network, channel, modes)
+        return
+    conn.send('MODE ' + channel + ' -' + modes)
+
+
+TIMER_ACTIONS = {
+    'unban': timer_unban,
+    'fbexpire': timer_fb_expire,
+    'unlock': timer_unlock,
+}
+
+DURATION = re.compile(r'^(?:\d+[smhdw])+$')
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_duration(text):
+    # '30m', '1h30m', '2d' -> seconds, None if text is not a duration
+    if not text or not DURATION.match(text.lower()):
+        return None
+    return sum(int(number) * DURATION_UNITS[unit] for number, unit in re.findall(r'(\d+)([smhdw])', text.lower()))
+
+
+def timed_ban(conn, channel, mask, seconds):
+    # schedules the removal of a ban the bot has just set
+    if seconds:
+        for entry in conn.bot.scheduler.find('unban', conn.name, channel, mask):
+            conn.bot.scheduler.cancel(entry)
+        conn.bot.scheduler.schedule(seconds, 'unban', conn.name, channel, mask)
+
+
+def op_delay(config):
+    # 'op_delay=2-8' waits 2 to 8 seconds, 'op_delay=5' up to 5
+    low, _, high = config.get('op_delay', '0').partition('-')
+    low, high = (float(low), float(high)) if high else (0.0, float(low or 0))
+    return random.uniform(low, high) if high > 0 else 0
+
+
+def delayed_op(conn, channel, nicks):
+    # only op whoever is still there and still not opped by somebody else
+    if conn.writer is None or not bot_is_op(conn, channel):
+        return
+    nicks = [member[0].nick for member in (conn.state.member(channel, nick) for nick in nicks)
+             if member is not None and not conn.state.has_mode(member[1], 'o')]
+    for line in mode_lines(channel, '+', 'o', nicks, conn.isupport):
+        conn.send(line)
+
 
 def create_config():
     wizard = ConfigWizard()
@@ -184,441 +1012,3597 @@ def check_files():
 
 
 def load_config():
+    # key=value lines. A '[name]' line starts the settings of one network,
+    # keys above the first section are defaults for every network.
     config = {}
+    networks = {}
+    current = config
     with open('config.txt', 'r') as f:
         for line in f:
-            key, value = line.strip().split('=')
-            config[key] = value
+            line = line.strip()
+            if not line or line.startswith(';'):
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                current = networks.setdefault(line[1:-1].strip(), {})
+                continue
+            key, sep, value = line.partition('=')
+            if sep:
+                current[key.strip()] = value.strip()
+    config['networks'] = networks
     return config
 
 
-def load_owners():
-    owners = []
-    with open('owner.txt', 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line and not line.startswith('#'):
-                owners.append(r"{}".format(line.replace('*', '.*')))
-    return owners
+def config_flag(config, key, default='0'):
+    return config.get(key, default).lower() not in ('', '0', 'no', 'off', 'false')
 
 
-def load_fb():
-    fb_data = {}
-    with open('fb.txt', 'r') as f:
-        for line in f:
-            line = line.strip()
-            if line:
-                if line.startswith('#'):
-                    channel, host, flag = line.split()
-                    if channel not in fb_data:
-                        fb_data[channel] = []
-                    fb_data[channel].append((host, flag))
-    return fb_data
+def split_server(server, port=6667):
+    # 'host', 'host:port' or '[ipv6]:port'
+    if server.startswith('['):
+        host, _, rest = server[1:].partition(']')
+        return host, int(rest[1:]) if rest.startswith(':') else port
+    if server.count(':') == 1:
+        host, _, server_port = server.partition(':')
+        return host, int(server_port)
+    return server, port
 
 
-def is_owner(sender, owners):
-    return any(re.search(owner, sender) for owner in owners)
-
-def add_fb(fb_data, channel, host, flag, irc):
-    if channel not in fb_data:
-        fb_data[channel] = []
-    entry = (host, flag)
-    if entry not in fb_data[channel]:
-        fb_data[channel].append(entry)
-        with open('fb.txt', 'a') as f:
-            f.write(f"{channel} {host} {flag}\n")
+def network_configs(config):
+    # One settings dict per network. Without any [section] the plain
+    # config.txt is a single network called 'default'.
+    sections = config.get('networks') or {'default': {}}
+    defaults = {key: value for key, value in config.items() if key != 'networks'}
+    networks = {}
+    for name, section in sections.items():
+        network = dict(defaults)
+        network.update(section)
+        network['name'] = name
+        port = int(network.get('port') or (6697 if config_flag(network, 'tls') else 6667))
+        servers = network.get('servers') or network.get('server', '')
+        network['servers'] = [split_server(server, port) for server in servers.replace(',', ' ').split()]
+        channels = network.get('channels') or network.get('channel') or ''
+        network['channels'] = channels.replace(',', ' ').split()
+        if not network['servers'] or not network.get('nick'):
+            log.warning(f"Network {name} has no server or nick in config.txt, skipping it.")
+            continue
+        networks[name] = network
+    return networks
+
+
+def add_fb(bot, channel, host, flag, network='', expires=None):
+    if bot.fb.add((channel, host, flag, network)):
+        if expires:
+            bot.scheduler.schedule(expires, 'fbexpire', network, channel, host, flag)
         if flag == 'd':
-            process_channel(channel, host, irc)
+            for target in bot.connections_for(network):
+                target.spawn(sweep_channel(target, channel))
         return True
     else:
         return False
 
 
-def process_channel(channel, host, irc):
-    irc.send(('WHO ' + channel + '\r\n').encode())
-    time.sleep(2)
-    response = irc.recv(2048).decode()
-    lines = response.split('\n')
+def bot_is_op(conn, channel):
+    member = conn.state.member(channel, conn.nick)
+    return member is not None and conn.state.has_mode(member[1], 'o')
 
-    for line in lines:
-        if line.startswith(':') and '352' in line:
-            parts = line.split()
-            if len(parts) > 7:
-                nick = parts[7]
-                ident_host = parts[4] + '@' + parts[5]
-                if re.match(re.escape(host), "*!" + ident_host):
-                    ban_mask = '*!*' + ident_host
-                    irc.send(('MODE ' + channel + ' +b ' + ban_mask + '\r\n').encode())
-                    irc.send(('KICK ' + channel + ' ' + nick + ' :Proton Shitlisted!\r\n').encode())
-                    break
 
+def enforce_fb(conn, channel, users):
+    # Match a batch of (nick, ident@host) on channel against the fb list and
+    # act on all of them with as few MODE/KICK lines as possible.
+    indexes = conn.bot.fb.lookup(conn.name, channel)
+    if not indexes or not bot_is_op(conn, channel):
+        return
+    ops, bans, kicks = [], [], []
+    link = conn.bot.link
+    mask_match = conn.metrics.mask_match
+    for nick, userhost in users:
+        # with linked bots each user is handled by one of them
+        if not link.mine(conn, channel, userhost.rpartition('@')[2].lower()):
+            continue
+        hostmask = nick + '!' + userhost
+        start = time.perf_counter()
+        for index in indexes:
+            matches = index.match(hostmask)
+            if matches:
+                break
+        mask_match.observe(time.perf_counter() - start)
+        if not matches:
+            continue
+        host_pattern, flag = matches[0]
+        if flag == 'f':
+            member = conn.state.member(channel, nick)
+            if member is None or not conn.state.has_mode(member[1], 'o'):
+                ops.append(nick)
+        elif flag == 'd':
+            ban_mask = '*!*' + userhost
+            if ban_mask not in bans:
+                bans.append(ban_mask)
+            kicks.append(nick)
+    delay = op_delay(conn.config)
+    if ops and delay:
+        conn.bot.scheduler.call_later(delay, delayed_op, conn, channel, ops)
+    else:
+        for line in mode_lines(channel, '+', 'o', ops, conn.isupport):
+            conn.send(line)
+    if kicks:
+        log_action.info('%s%s: kickban %s', conn.label, channel, ' '.join(kicks))
+    ban_time = parse_duration(conn.config.get('fb_ban_time', ''))
+    for line in ban_lines(conn, channel, bans, seconds=ban_time):
+        conn.send(line)
+    for line in kick_lines(channel, kicks, 'Proton Shitlisted!', conn.isupport):
+        conn.send(line)
 
-def remove_fb(fb_data, channel, host, flag, irc):
-    if channel in fb_data:
-        entry = (host, flag)
-        if entry in fb_data[channel]:
-            fb_data[channel].remove(entry)
-            with open('fb.txt', 'r') as f:
-                lines = f.readlines()
-            with open('fb.txt', 'w') as f:
-                for line in lines:
-                    if f"{channel} {host} {flag}" not in line:
-                        f.write(line)
 
-            if flag == 'd':
-                remove_ban(channel, host, irc)
+async def sweep_channel(conn, channel):
+    # Check everybody already on the channel, used when the bot gets opped
+    # and when a new 'd' entry is added.
+    tracked = conn.state.channel(channel)
+    if tracked is None:
+        return
+    await tracked.synced.wait()
+    users = [(user.nick, user.ident + '@' + user.host)
+             for user, prefixes in conn.state.members(channel) if user.host is not None]
+    enforce_fb(conn, channel, users)
 
-            return True
+
+def remove_fb(bot, channel, host, flag, network=''):
+    if bot.fb.remove((channel, host, flag, network)):
+        fb_removed(bot, channel, host, flag, network)
+        return True
     return False
 
 
-def format_fb(fb_data):
+def fb_removed(bot, channel, host, flag, network):
+    # drops the expiry timer and, for 'd', the bans of an entry that is gone
+    for entry in bot.scheduler.find('fbexpire', network, channel, host):
+        if entry[5] == flag:
+            bot.scheduler.cancel(entry)
+    if flag == 'd':
+        for target in bot.connections_for(network):
+            remove_ban(target, channel, host)
+
+
+FB_MASK = re.compile(r'^[^\s!@]+![^\s!@]+@[^\s!@]+$')
+FB_FLAGS = ('f', 'd')
+
+
+def parse_fb_line(line, channel=None, flag=None, network=''):
+    # '#channel mask flag [network]', or just 'mask' when channel and flag
+    # are given
+    fields = line.split()
+    if len(fields) == 1 and channel and flag:
+        fields = [channel, fields[0], flag, network]
+    elif len(fields) == 3:
+        fields.append(network)
+    if len(fields) != 4:
+        return None
+    channel, host, flag, network = fields
+    if not channel.startswith('#') or not FB_MASK.match(host) or flag not in FB_FLAGS:
+        return None
+    return channel, host, flag, network
+
+
+def import_fb(fb, lines, channel=None, flag=None, network=''):
+    # Validate and dedupe, then add everything in one transaction.
+    # Returns (added entries, duplicates, invalid lines).
+    entries = []
+    invalid = 0
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith(';'):
+            continue
+        entry = parse_fb_line(line, channel, flag, network)
+        if entry is None:
+            invalid += 1
+        else:
+            entries.append(entry)
+    added = fb.add_many(entries)
+    return added, len(entries) - len(added), invalid
+
+
+def select_fb(fb, channel=None, network=None):
+    key = channel.translate(RFC1459_LOWER) if channel else None
+    for entry in fb:
+        if key is not None and entry[0].translate(RFC1459_LOWER) != key:
+            continue
+        if network is not None and entry[3] != network:
+            continue
+        yield entry
+
+
+def export_fb(fb, channel=None, network=None):
+    # streams fb entries in the same format fb-import reads
+    for entry in select_fb(fb, channel, network):
+        yield fb.format(entry)
+
+
+def format_fb(fb, channel=None, network=None):
+    # Packs the entries of every channel into as few lines as fit, instead
+    # of one PRIVMSG per entry.
     formatted_fb = ['List of fbs:']
-    for channel, hosts in fb_data.items():
-        for host, flag in hosts:
-            formatted_fb.append(f"{channel} {host} {flag}")
+    by_channel = {}
+    for fb_channel, host, flag, fb_network in select_fb(fb, channel, network):
+        if fb_network:
+            fb_channel += ' on ' + fb_network
+        by_channel.setdefault(fb_channel, []).append(host + ' ' + flag)
+    for fb_channel, entries in by_channel.items():
+        current = fb_channel + ':'
+        for entry in entries:
+            if len(current) + len(entry) + 2 > LINE_LIMIT:
+                formatted_fb.append(current)
+                current = fb_channel + ':'
+            current += (' ' if current.endswith(':') else ', ') + entry
+        formatted_fb.append(current)
     return formatted_fb
 
 
-def process_fb(sender, channel, fb_data, irc):
-    modified_sender = "*!" + sender.split('!')[1]
-    channel = channel.replace(':#', '#')
-    for fb_channel, fb_hosts in fb_data.items():
-        if fb_channel == channel:
-            for host_pattern, flag in fb_hosts:
-                if re.match(re.escape(host_pattern), modified_sender):
-                    if flag == 'f':
-                        irc.send(('MODE ' + channel + ' +o ' + sender.split('!')[0] + '\r\n').encode())
-                    elif flag == 'd':
-                        ban_mask = '*!*' + sender.split('!')[1]
-                        irc.send(('MODE ' + channel + ' +b ' + ban_mask + '\r\n').encode())
-                        irc.send(('KICK ' + channel + ' ' + sender.split('!')[0] + ' :Proton Shitlisted!\r\n').encode())
-                    break
+def apply_fb_import(bot, added):
+    # one enforcement sweep per channel that got new 'd' entries
+    channels = {}
+    for channel, host, flag, network in added:
+        if flag == 'd':
+            channels.setdefault((network, channel.translate(RFC1459_LOWER)), channel)
+    for (network, key), channel in channels.items():
+        for conn in bot.connections_for(network):
+            conn.spawn(sweep_channel(conn, channel))
 
-def remove_ban(channel, host, irc):
-    ban_mask = '*!*' + host.split('!')[1]
-    irc.send(('MODE ' + channel + ' -b ' + ban_mask + '\r\n').encode())
-
-def jump_server(config, irc, channels, new_server_address):
-    new_server = new_server_address.strip()
-
-    # get list of channels before QUIT
-    irc.send(('WHOIS ' + config['nick'] + ' ' + config['nick'] +'\r\n').encode())
-    time.sleep(2)
-    response = irc.recv(2048).decode()
-    if "319" in response:
-        for line in response.split("\n"):
-            if line.startswith(":") and "319" in line:
-                channel_list = line.split(":")[2]
-                channels = set(channel.strip("@+").replace("@#", "#") for channel in channel_list.split())
-                break
 
-    irc.send(('QUIT :Jumping to new server\r\n').encode())
-    irc.close()
+def remove_ban(conn, channel, host):
+    # The bans set for an fb entry are the *!*ident@host masks of whoever
+    # matched it, so every ban of ours whose ident@host the fb mask covers
+    # is taken off.
+    userhost = '*!' + host.split('!', 1)[1]
+    tracked = conn.state.channel(channel)
+    if tracked is not None and 'b' in tracked.known:
+        masks = [mask for mask, (setter, stamp) in tracked.lists.get('b', {}).items()
+                 if set_by_bot(conn, setter) and (mask_match(host, mask) or
+                                                  mask.startswith('*!*') and mask_match(userhost, '*!' + mask[3:]))]
+    else:
+        masks = [re.sub(r'\*+', '*', '*!*' + host.split('!', 1)[1])]
+    for line in unban_lines(conn, channel, masks):
+        conn.send(line)
 
-    irc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    irc.connect((new_server, int(config['port'])))
-    irc.send(('NICK ' + config['nick'] + '\r\n').encode())
-    irc.send(('USER ' + config['nick'] + ' 0 * :' + config['nick'] + '\r\n').encode())
-    
-    # rejoin channels
-    for channel in channels:
-        irc.send(('JOIN ' + channel + '\r\n').encode())
 
-    return irc
+LIST_REPLIES = {'b': ('367', '368'), 'e': ('348', '349'), 'I': ('346', '347')}
+BAN_SLACK = 2
 
-def get_address_family(ip):
+
+def set_by_bot(conn, setter):
+    # by any nick the bot has gone by on this network, so bans set before a
+    # nick change, or from the standby link, still count as its own
+    nick = conn.state.key(setter.split('!', 1)[0])
+    nicks = conn.nicks_used | {conn.nick, conn.config['nick'], conn.config.get('standby_nick') or conn.config['nick']}
+    return any(conn.state.key(used) == nick for used in nicks)
+
+
+def ban_lines(conn, channel, masks, mode='b', seconds=None):
+    # MODE lines that set masks on channel. Masks that are already set, or
+    # covered by one that is (*!*@host covers *!*ident@host), are left out.
+    # When the list would come within BAN_SLACK of MAXLIST the oldest bans
+    # the bot set itself are taken off first. With seconds the new bans are
+    # timed.
+    entries = conn.state.list_entries(channel, mode)
+    if entries is None:
+        return mode_lines(channel, '+', mode, masks, conn.isupport)
+    new = []
+    for mask in masks:
+        if not any(mask_match(existing, mask) for existing in entries) and \
+                not any(mask_match(existing, mask) for existing in new):
+            new.append(mask)
+    removed = []
+    limit = conn.isupport.list_limit(mode)
+    if limit is not None and new:
+        lists = conn.state.channel(channel).lists
+        used = sum(len(lists.get(group_mode, ())) for group_mode in conn.isupport.list_group(mode))
+        excess = used + len(new) - max(1, limit - BAN_SLACK)
+        if excess > 0:
+            removed = [mask for mask, (setter, stamp) in entries.items() if set_by_bot(conn, setter)][:excess]
+            if excess > len(removed):
+                new = new[:max(0, len(new) - (excess - len(removed)))]
+    with conn.bot.scheduler.transaction():
+        for mask in removed:
+            del entries[mask]
+            for entry in conn.bot.scheduler.find('unban', conn.name, channel, mask):
+                conn.bot.scheduler.cancel(entry)
+        for mask in new:
+            conn.state.list_add(channel, mode, mask, conn.nick)
+            timed_ban(conn, channel, mask, seconds)
+    return mode_lines(channel, '-', mode, removed, conn.isupport) + mode_lines(channel, '+', mode, new, conn.isupport)
+
+
+def unban_lines(conn, channel, masks, mode='b'):
+    # -b only for masks that are set, as far as the bot knows the list
+    tracked = conn.state.channel(channel)
+    if tracked is not None and mode in tracked.known:
+        masks = [mask for mask in masks if conn.state.list_remove(channel, mode, mask)]
+    return mode_lines(channel, '-', mode, masks, conn.isupport)
+
+def mass_targets(conn, channel, sender_nick):
+    # everybody on the channel except the bot, the sender and other owners
+    keep = (conn.state.key(conn.nick), conn.state.key(sender_nick))
+    for user, prefixes in list(conn.state.members(channel)):
+        if conn.state.key(user.nick) in keep:
+            continue
+        if user.host is not None and is_owner(user.mask(), conn.bot.owners):
+            continue
+        yield user, prefixes
+
+async def resolve_host(conn, nick):
+    # only needed when a user was seen in NAMES but the channel WHO is not done
+    lines = await conn.request('WHO ' + nick, ('352',), ('315',))
+    for msg in lines:
+        params = msg.params
+        if len(params) > 5 and conn.state.key(params[5]) == conn.state.key(nick):
+            user = conn.state.user(nick)
+            if user is not None:
+                conn.state.set_host(user, params[2], params[3])
+            break
+
+async def whois_channels(conn, nick):
+    # 319 may be split over several lines on busy bots, collect all of them
+    lines = await conn.request('WHOIS ' + nick + ' ' + nick, ('319',), ('318', '401'))
+    channels = []
+    for msg in lines:
+        if len(msg.params) > 2:
+            channels.extend(channel.lstrip(conn.state.prefix_symbols) for channel in msg.params[2].split())
+    return channels
+
+async def jump_server(conn, new_server_address=None):
+    # The new link registers while the old one stays up, connect() swaps them
+    # and the channels are rejoined from the bot's own list. Without an
+    # address the bot goes to the standby link or the fastest other server.
+    if new_server_address:
+        server = split_server(new_server_address.strip(), conn.server[1])
+    elif conn.standby is not None and conn.standby.alive:
+        server = conn.standby.server
+    else:
+        others = conn.pool.ranked(exclude=conn.server)
+        if not others:
+            raise ValueError('no other server configured')
+        server = others[0]
+    await conn.connect(server)
+
+
+def format_servers(conn):
+    # one line per server: round trip time and what the bot uses it for
+    lines = []
+    for server in conn.pool.servers:
+        line = f"{server[0]}:{server[1]} "
+        if server not in conn.pool.rtt:
+            line += 'not measured'
+        elif conn.pool.rtt[server] is None:
+            line += 'down'
+        else:
+            line += f"{conn.pool.rtt[server] * 1000:.0f} ms"
+        if server == conn.server:
+            line += ' (current)'
+        if conn.standby is not None and conn.standby.alive and server == conn.standby.server:
+            line += f' (standby as {conn.standby.nick})'
+        lines.append(line)
+    return lines
+
+def decode_line(raw):
     try:
-        socket.inet_pton(socket.AF_INET, ip)
-        return socket.AF_INET
-    except socket.error:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+
+class LineReader:
+    # Turns the raw byte stream from the server into complete IRC lines.
+    # A line split across two recv() calls is kept in the buffer until the
+    # rest of it arrives, so no event is lost or cut in half.
+    max_line = 16384
+
+    def __init__(self):
+        self.buffer = b''
+        self.pending = deque()
+
+    def feed(self, data):
+        data = self.buffer + data if self.buffer else data
+        end = data.rfind(b'\n')
+        if end < 0:
+            # no complete line yet, drop garbage that can never become one
+            self.buffer = data if len(data) <= self.max_line else b''
+            return []
+        self.buffer = data[end + 1:]
+        chunk = data[:end]
         try:
-            socket.inet_pton(socket.AF_INET6, ip)
-            return socket.AF_INET6
-        except socket.error:
-            return None
+            # fast path: the whole chunk is valid UTF-8
+            lines = chunk.decode('utf-8').split('\n')
+        except UnicodeDecodeError:
+            lines = [decode_line(raw) for raw in chunk.split(b'\n')]
+        lines = [line[:-1] if line.endswith('\r') else line for line in lines]
+        lines = [line for line in lines if line]
+        self.pending.extend(lines)
+        return lines
 
-def create_socket(config):
-    try:
-        if 'bind_ip' in config:
-            address_family = get_address_family(config['bind_ip'])
-            if address_family is not None:
-                irc = socket.socket(address_family, socket.SOCK_STREAM)
-                irc.bind((config['bind_ip'], 0))
-            else:
-                raise ValueError("Invalid IP address in configuration.")
-        else:
-            irc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        irc.connect((config['server'], int(config['port'])))
-    except OSError as e:
-        if e.errno == 49:
-            print(f"Cannot assign requested address {config.get('bind_ip', '0.0.0.0')}. Please use a valid IP address or 0.0.0.0 for localhost.")
-        else:
-            print(f"An error occurred: {e}")
-        exit(1)
-    return irc
 
+WHOX_TOKEN = '152'
 
-def save_config(config):
-    with open('config.txt', 'w') as config_file:
-        for key, value in config.items():
-            config_file.write(f'{key}={value}\n')
 
-def main():
-    config = {}
-    args = parse_arguments()
+TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
 
-    if any(vars(args).values()):
-        if args.bind_ip:
-            config['bind_ip'] = args.bind_ip
-        if args.server:
-            config['server'] = args.server
-        if args.port:
-            config['port'] = args.port
-        if args.nick:
-            config['nick'] = args.nick
-        if args.owner:
-            with open('owner.txt', 'w') as f:
-                f.write(args.owner + '\n')
-        if args.channel and not args.channel.startswith('#'):
-            print("Invalid channel name. Use '#' before the channel name.")
+
+def unescape_tag(value):
+    if '\\' not in value:
+        return value
+    out = []
+    chars = iter(value)
+    for c in chars:
+        if c == '\\':
+            c = next(chars, '')
+            out.append(TAG_ESCAPES.get(c, c))
         else:
-            config['channel'] = args.channel
+            out.append(c)
+    return ''.join(out)
 
-        save_config(config)
 
-    # Check if required files exist, create them if they don't
-    if not os.path.isfile('config.txt'):
-        create_config()
-    if not os.path.isfile('owner.txt'):
-        create_owner()
-    if not os.path.isfile('fb.txt'):
-        open('fb.txt', 'a').close()
+class Message:
+    # One parsed IRC line: '@tags :nick!user@host COMMAND params :trailing'.
+    # Tags are only split and unescaped when somebody asks for them.
+    __slots__ = ('raw_tags', '_tags', 'prefix', 'nick', 'user', 'host', 'command', 'params')
 
-    config = load_config()
-    owners = load_owners()
-    fb_data = load_fb()
-    channels = set()
+    def __init__(self, raw_tags, prefix, command, params):
+        self.raw_tags = raw_tags
+        self._tags = None
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        bang = prefix.find('!')
+        if bang < 0:
+            self.nick = prefix
+            self.user = self.host = None
+        else:
+            at = prefix.find('@', bang)
+            self.nick = prefix[:bang]
+            self.user = prefix[bang + 1:at] if at > 0 else prefix[bang + 1:]
+            self.host = prefix[at + 1:] if at > 0 else None
 
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = {}
+            if self.raw_tags:
+                for tag in self.raw_tags.split(';'):
+                    key, _, value = tag.partition('=')
+                    self._tags[key] = unescape_tag(value)
+        return self._tags
 
-    irc = create_socket(config)
-    irc.send(('NICK ' + config['nick'] + '\r\n').encode())
-    irc.send(('USER ' + config['nick'] + ' 0 * :' + config['nick'] + '\r\n').encode())
-    irc.send(('JOIN ' + config['channel'] + '\r\n').encode())
+    @property
+    def source(self):
+        # nick!user@host
+        return self.prefix
 
-    while True:
-        message = irc.recv(2048).decode(errors='ignore')
-        print(message)
+    def param(self, index, default=None):
+        params = self.params
+        return params[index] if len(params) > index else default
 
-        if "Closing Link" in message:
-            print("Connection closed by server with message:", message)
-            irc.close()
-            break
+    def __repr__(self):
+        return f"Message({self.prefix!r}, {self.command!r}, {self.params!r})"
 
-        if message.startswith('PING'):
-            irc.send(('PONG ' + message.split()[1] + '\r\n').encode())
 
-        elif 'JOIN' in message:
-            message_lines = message.split('\n')
-            join_line = None
+COMMAND_NAMES = {}
 
-            for line in message_lines:
-                if 'JOIN' in line:
-                    message = line
-                    break
 
-            if message:
-                print(message)
-                sender = message.split('!')[0][1:] + '!' + message.split('!')[1].split()[0]
-                channel = message.split('JOIN ')[1].strip()
-                process_fb(sender, channel, fb_data, irc)
-            else:
-                print("Nie znaleziono linii z ciągiem 'JOIN'.")
-
-  
-        elif re.search(r'PRIVMSG', message):
-            sender = message.split('!')[0][1:] + '!' + message.split('!')[1].split()[0]
-            command = message.split('PRIVMSG')[1].strip().split(' :')[1]
-
-            if is_owner(sender, owners):
-                if command.startswith('.op '):
-                    nick_to_op = command.split(' ')[1]
-                    channel = message.split()[2]
-
-                    irc.send(('MODE ' + channel + ' +o ' + nick_to_op + '\r\n').encode())
-
-                if command.startswith('.+own ') or command.startswith('.-own ') or command == '.own':
-                    response = handle_owner_command(command, sender, owners)
-                    if response:
-                        for line in response.split('\n'):
-                            irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :' + line + '\r\n').encode())
-                                        
-                elif command.startswith('.k '):
-                    command_split = command.split(' ', 2)
-                    nick_to_kick = command_split[1]
-                    if len(command_split) > 2:
-                        kick_reason = command_split[2]
-                    else:
-                        kick_reason = 'Proton Has You'
-
-                    # Get the channel from the message
-                    channel = message.split()[2]
-
-                    # Check if nick_to_kickban is in the channel
-                    irc.send(('WHO ' + channel + '\r\n').encode())
-                    time.sleep(0.5)
-                    response = irc.recv(2048).decode()
-                    lines = response.split('\n')
-
-                    for line in lines:
-                        if line.startswith(':') and '352' in line:
-                            parts = line.split()
-                            if len(parts) > 7:
-                                nick = parts[7]
-                                if nick == nick_to_kick:
-                                    irc.send(('KICK ' + channel + ' ' + nick + ' :' + kick_reason + '\r\n').encode())
-                                    break
-                
-                elif command == '.mk':
-                    # Get the channel from the message
-                    channel = message.split()[2]
-
-                    # Get the list of users in the channel
-                    irc.send(('WHO ' + channel + '\r\n').encode())
-                    time.sleep(0.5)
-                    response = irc.recv(2048).decode()
-                    lines = response.split('\n')
-                    irc.send(('WHOIS').encode())
-                    time.sleep(0.5)
-                    response = irc.recv(2048).decode()
-                    bot_nick = extract_nick_from_whois(response)
-                    kick_list = []
-                    owner_nick = sender.split('!')[0]
-
-                    for i in range(0, len(lines), 4):
-                        nick_block = lines[i:i+4]
-                        kick_block = []
-                        for line in nick_block:
-                            if line.startswith(':') and '352' in line:
-                                parts = line.split()
-                                if len(parts) > 7:
-                                    nick = parts[7]
-                                    ident_host = parts[4] + '@' + parts[5]
-                                    if nick != bot_nick:
-                                        if nick != owner_nick:
-                                            kick_block.append(nick)
-                        if kick_block:
-                            kick_list.append(','.join(kick_block))
-
-                    # Kick users one by one
-                    for block in kick_list:
-                        irc.send(('KICK ' + channel + ' ' + block + ' :protoGen Mass Kick\r\n').encode())
-
-
-
-                # Add new .kb command
-                elif command.startswith('.kb '):
-                    command_split = command.split(' ', 2)
-                    nick_to_kickban = command_split[1]
-                    if len(command_split) > 2:
-                        kick_reason = command_split[2]
-                    else:
-                        kick_reason = 'Proton Has You'
-
-                    # Get the channel from the message
-                    channel = message.split()[2]
-
-                    # Check if nick_to_kickban is in the channel
-                    irc.send(('WHO ' + channel + '\r\n').encode())
-                    time.sleep(0.5)
-                    response = irc.recv(2048).decode()
-                    lines = response.split('\n')
-
-                    for line in lines:
-                        if line.startswith(':') and '352' in line:
-                            parts = line.split()
-                            if len(parts) > 7:
-                                nick = parts[7]
-                                ident_host = parts[4] + '@' + parts[5]
-                                if nick == nick_to_kickban:
-                                    if '~' in ident_host:
-                                        ban_mask = '*!*@' + parts[5]
-                                    else:
-                                        ban_mask = '*!*' + ident_host
-                                    irc.send(('MODE ' + channel + ' +b ' + ban_mask + '\r\n').encode())
-                                    irc.send(('KICK ' + channel + ' ' + nick + ' :' + kick_reason + '\r\n').encode())
-                                    break
-
-
-                elif command.startswith('.deop '):
-                    nick_to_deop = command.split(' ')[1]
-                    channel = message.split()[2]
-
-                    irc.send(('MODE ' + channel + ' -o ' + nick_to_deop + '\r\n').encode())
-
-                elif command.startswith('.+fb '):
-                    command_split = command.split()
-                    if "#" in command and "!" in command:                    
-                        if len(command_split) == 4:
-                            channel, host, flag = command_split[1:]
-                            if add_fb(fb_data, channel, host, flag, irc):
-                                irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :Added ' + command.split(' ')[1] + ' to fb list.\r\n').encode())
-                            else:
-                                irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :fb entry already exists.\r\n').encode())
-                        else:
-                            irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :Not enough arguments for .+fb command. Please provide 3 arguments.\r\n').encode())
-                    else:
-                        irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :Incorrect data format. Please use the following format: #channel *!ident@host flag\r\n').encode())
-
-                elif command.startswith('.-fb '):
-                    command_split = command.split()
-                    if "#" in command and "!" in command:
-                        if len(command_split) == 4:
-                            channel = command_split[1]
-                            host = command_split[2]
-                            flag = command_split[-1]
-                            if remove_fb(fb_data, channel, host, flag, irc):
-                                irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :Removed ' + command.split(' ')[1] + ' from fb list.\r\n').encode())
-                            else:
-                                irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :fb entry not found.\r\n').encode())
-                        else:
-                            irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :Not enough arguments for .-fb command. Please provide at least 3 arguments.\r\n').encode())
-                    else:
-                        irc.send(('PRIVMSG ' + sender.split('!')[0] + ' :Incorrect data format. Please use the following format: #channel *!ident@host flag\r\n').encode())
-
-                elif command.startswith('.fb'):
-                    fb_list = format_fb(fb_data)
-                    for line in fb_list:
-                        irc.send(('PRIVMSG ' + sender + ' :' + line + '\r\n').encode())
-
-                elif command.startswith('.join '):
-                    channel = command.split(' ')[1]
-                    irc.send(('JOIN ' + channel + '\r\n').encode())
-
-                elif command.startswith('.part '):
-                    channel = command.split(' ')[1]
-                    irc.send(('PART ' + channel + ' :' + 'Arrivederci roma' + '\r\n').encode())
-
-                elif command.startswith('.lc'):
-                    irc.send(('WHOIS ' + config['nick'] + ' ' +  config['nick'] +'\r\n').encode())
-                    time.sleep(2)
-                    response = irc.recv(2048).decode()
-                    if "319" in response:
-                        channel_list = ""
-                        for line in response.split("\n"):
-                            if line.startswith(":") and "319" in line:
-                                channel_list = line.split(":")[2]
-                                break
-                        irc.send(('PRIVMSG ' + sender + ' :Channels: ' + channel_list + '\r\n').encode())
-                        print(f"Sent channel list to {sender}")
-                    else:
-                        irc.send(('PRIVMSG ' + sender + ' :Unable to retrieve channel list.\r\n').encode())
-                        print(f"Unable to retrieve channel list for {sender}")
-
-                elif command.startswith('.jump '):
-                    new_server_address = command.split(' ')[1]
-                    irc = jump_server(config, irc, channels, new_server_address)
+def parse_message(line, names=COMMAND_NAMES):
+    raw_tags = ''
+    if line[:1] == '@':
+        space = line.find(' ')
+        if space < 0:
+            return None
+        raw_tags = line[1:space]
+        line = line[space + 1:].lstrip(' ')
+    prefix = ''
+    if line[:1] == ':':
+        space = line.find(' ')
+        if space < 0:
+            return None
+        prefix = line[1:space]
+        line = line[space + 1:]
+    trailing = line.find(' :')
+    if trailing >= 0:
+        params = line[:trailing].split()
+        params.append(line[trailing + 2:])
+    else:
+        params = line.split()
+    if not params or (trailing >= 0 and len(params) == 1):
+        return None
+    name = params[0]
+    command = names.get(name)
+    if command is None:
+        # command names are interned, every handler compares the same object
+        command = names[name] = sys.intern(name.upper())
+    del params[0]
+    return Message(raw_tags, prefix, command, params)
+
 
+def parse_modes(modes, args, prefix_modes, chanmodes):
+    # Yields (adding, mode, argument) for a MODE change such as '+ob-v a b c'.
+    # Which modes take an argument comes from PREFIX and CHANMODES.
+    list_modes, always, on_set = chanmodes[0], chanmodes[1], chanmodes[2]
+    args = iter(args)
+    adding = True
+    for mode in modes:
+        if mode == '+':
+            adding = True
+        elif mode == '-':
+            adding = False
+        elif mode in prefix_modes or mode in list_modes or mode in always or (adding and mode in on_set):
+            yield adding, mode, next(args, None)
+        else:
+            yield adding, mode, None
+
+
+ASCII_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')
+STRICT_RFC1459_LOWER = str.maketrans('ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\', 'abcdefghijklmnopqrstuvwxyz{}|')
+CASEMAPPINGS = {'ascii': ASCII_LOWER, 'rfc1459': RFC1459_LOWER, 'strict-rfc1459': STRICT_RFC1459_LOWER}
+# Servers relay our lines with ':nick!user@host ' in front and cut them at
+# 512 bytes, so bulk lines are kept well under that.
+LINE_LIMIT = 400
+
+
+class ISupport:
+    # What the server announced in RPL_ISUPPORT (005). Anything it did not
+    # announce falls back to the RFC1459 defaults.
+    def __init__(self):
+        self.tokens = {}
+        self.modes = 3
+        self.targmax = {}
+        self.maxlist = {}
+        self.list_groups = {}
+        self.casemapping = 'rfc1459'
+        self.lower = RFC1459_LOWER
+        self.prefix_modes = 'ov'
+        self.prefix_symbols = '@+'
+        self.chanmodes = ('beI', 'k', 'l', 'imnpst')
+
+    def __contains__(self, key):
+        return key in self.tokens
+
+    def get(self, key, default=None):
+        return self.tokens.get(key, default)
+
+    def update(self, tokens):
+        for token in tokens:
+            if token.startswith('-'):
+                self.tokens.pop(token[1:], None)
+                continue
+            key, _, value = token.partition('=')
+            self.tokens[key] = value
+            if key == 'MODES':
+                self.modes = int(value) if value.isdigit() else 12
+            elif key == 'TARGMAX':
+                for item in value.split(','):
+                    command, _, limit = item.partition(':')
+                    self.targmax[command.upper()] = int(limit) if limit.isdigit() else None
+            elif key == 'MAXLIST':
+                for item in value.split(','):
+                    modes, _, limit = item.partition(':')
+                    for mode in modes:
+                        self.maxlist[mode] = int(limit) if limit.isdigit() else None
+                        self.list_groups[mode] = modes
+            elif key == 'CASEMAPPING':
+                self.casemapping = value.lower()
+                self.lower = CASEMAPPINGS.get(self.casemapping, RFC1459_LOWER)
+            elif key == 'PREFIX' and value.startswith('(') and ')' in value:
+                self.prefix_modes, self.prefix_symbols = value[1:].split(')', 1)
+            elif key == 'CHANMODES' and value.count(',') >= 3:
+                self.chanmodes = tuple(value.split(',')[:4])
+
+    def max_targets(self, command, default=1):
+        # None means the server does not limit it
+        return self.targmax.get(command, default)
+
+    def list_limit(self, mode):
+        return self.maxlist.get(mode)
+
+    def list_group(self, mode):
+        # 'MAXLIST=beI:100' is one limit for all three lists together
+        return self.list_groups.get(mode, mode)
+
+
+def mode_lines(channel, sign, mode, targets, isupport):
+    # MODE #chan +oooo a b c d, as many changes per line as MODES allows
+    lines = []
+    head = f'MODE {channel} {sign}'
+    batch = []
+    length = len(head)
+    for target in targets:
+        if batch and (len(batch) >= isupport.modes or length + len(target) + 2 > LINE_LIMIT):
+            lines.append(head + mode * len(batch) + ' ' + ' '.join(batch))
+            batch = []
+            length = len(head)
+        batch.append(target)
+        length += len(target) + 2
+    if batch:
+        lines.append(head + mode * len(batch) + ' ' + ' '.join(batch))
+    return lines
+
+
+def pack_targets(head, targets, tail, limit):
+    # head + a,b,c + tail, at most limit targets and LINE_LIMIT characters a line
+    lines = []
+    batch = []
+    length = len(head) + len(tail)
+    for target in targets:
+        if batch and (len(batch) >= limit or length + len(target) + 1 > LINE_LIMIT):
+            lines.append(head + ','.join(batch) + tail)
+            batch = []
+            length = len(head) + len(tail)
+        batch.append(target)
+        length += len(target) + 1
+    if batch:
+        lines.append(head + ','.join(batch) + tail)
+    return lines
+
+
+def kick_lines(channel, nicks, reason, isupport):
+    # KICK #chan a,b,c :reason, as many nicks per line as TARGMAX allows
+    limit = isupport.max_targets('KICK', 4) or len(nicks) or 1
+    return pack_targets(f'KICK {channel} ', nicks, ' :' + reason, limit)
+
+
+def join_lines(channels, isupport):
+    # JOIN #a,#b,#c, used to rejoin everything after a reconnect
+    limit = isupport.max_targets('JOIN', None) or len(channels) or 1
+    return pack_targets('JOIN ', channels, '', limit)
+
+
+class User:
+    # account and away are only known with the IRCv3 capabilities
+    __slots__ = ('nick', 'ident', 'host', 'refs', 'account', 'away')
+
+    def __init__(self, nick, ident=None, host=None):
+        self.nick = nick
+        self.ident = ident
+        self.host = host
+        self.refs = 0
+        self.account = None
+        self.away = None
+
+    def mask(self):
+        return f"{self.nick}!{self.ident}@{self.host}"
+
+
+class Channel:
+    __slots__ = ('name', 'members', 'synced', 'lists', 'known')
+
+    def __init__(self, name):
+        self.name = name
+        # lowercased nick -> prefix symbols the user has here ('@', '+', '')
+        self.members = {}
+        self.synced = asyncio.Event()
+        # list mode ('b', 'e', 'I') -> mask -> (setter, unix time set), oldest
+        # first, and the list modes fetched from the server since joining
+        self.lists = {}
+        self.known = set()
+
+
+class StateTracker:
+    # Channels the bot is on, who is in them and with which ident@host and
+    # op/voice status. Seeded with one WHO per channel on join and kept up to
+    # date from JOIN/PART/QUIT/KICK/NICK/MODE, so commands never need to ask
+    # the server who is on a channel. Users are shared between channels and
+    # ident/host strings are interned, big channels stay cheap.
+    def __init__(self, clock=time):
+        self.clock = clock
+        self.users = {}
+        self.channels = {}
+        self.lower = RFC1459_LOWER
+        self.prefix_modes = 'ov'
+        self.prefix_symbols = '@+'
+        self.chanmodes = ('beI', 'k', 'l', 'imnpst')
+
+    def key(self, name):
+        return name.translate(self.lower)
+
+    def set_isupport(self, isupport):
+        self.prefix_modes = isupport.prefix_modes
+        self.prefix_symbols = isupport.prefix_symbols
+        self.chanmodes = isupport.chanmodes
+        if isupport.lower != self.lower:
+            # CASEMAPPING changed the keys, file everything again
+            old_users = self.users
+            self.lower = isupport.lower
+            self.users = {self.key(user.nick): user for user in old_users.values()}
+            for channel in self.channels.values():
+                channel.members = {self.key(old_users[key].nick): prefixes
+                                   for key, prefixes in channel.members.items()}
+            self.channels = {self.key(channel.name): channel for channel in self.channels.values()}
+
+    def has_mode(self, prefixes, mode):
+        # is mode 'o' among the prefix symbols '@+'
+        index = self.prefix_modes.find(mode)
+        return index >= 0 and self.prefix_symbols[index] in prefixes
+
+    def channel(self, name):
+        return self.channels.get(self.key(name))
+
+    def user(self, nick):
+        return self.users.get(self.key(nick))
+
+    def member(self, channel_name, nick):
+        # (User, prefix symbols) for nick on channel, None if not there
+        channel = self.channel(channel_name)
+        key = self.key(nick)
+        if channel is None or key not in channel.members:
+            return None
+        return self.users[key], channel.members[key]
+
+    def members(self, channel_name):
+        channel = self.channel(channel_name)
+        if channel is None:
+            return
+        users = self.users
+        for key, prefixes in channel.members.items():
+            yield users[key], prefixes
+
+    def add_channel(self, name):
+        key = self.key(name)
+        if key not in self.channels:
+            self.channels[key] = Channel(name)
+        return self.channels[key]
+
+    def remove_channel(self, name):
+        channel = self.channels.pop(self.key(name), None)
+        if channel is not None:
+            for key in channel.members:
+                self.release(key)
+
+    def add_member(self, channel_name, nick, ident=None, host=None, prefixes=''):
+        channel = self.channel(channel_name)
+        if channel is None:
+            return
+        key = self.key(nick)
+        user = self.users.get(key)
+        if user is None:
+            user = self.users[key] = User(nick)
+        if host:
+            self.set_host(user, ident, host)
+        if key not in channel.members:
+            user.refs += 1
+        channel.members[key] = sys.intern(prefixes)
+
+    def set_host(self, user, ident, host):
+        user.ident = sys.intern(ident)
+        user.host = sys.intern(host)
+
+    def remove_member(self, channel_name, nick):
+        channel = self.channel(channel_name)
+        key = self.key(nick)
+        if channel is not None and channel.members.pop(key, None) is not None:
+            self.release(key)
+
+    def release(self, key):
+        user = self.users.get(key)
+        if user is not None:
+            user.refs -= 1
+            if user.refs <= 0:
+                del self.users[key]
+
+    def quit(self, nick):
+        key = self.key(nick)
+        for channel in self.channels.values():
+            channel.members.pop(key, None)
+        self.users.pop(key, None)
+
+    def rename(self, old, new):
+        old_key, new_key = self.key(old), self.key(new)
+        user = self.users.pop(old_key, None)
+        if user is None:
+            return
+        user.nick = new
+        self.users[new_key] = user
+        for channel in self.channels.values():
+            if old_key in channel.members:
+                channel.members[new_key] = channel.members.pop(old_key)
+
+    def set_prefix(self, channel_name, nick, mode, adding):
+        channel = self.channel(channel_name)
+        key = self.key(nick)
+        if channel is None or key not in channel.members:
+            return
+        symbol = self.prefix_symbols[self.prefix_modes.index(mode)]
+        prefixes = channel.members[key].replace(symbol, '')
+        if adding:
+            # keep the symbols in PREFIX order, highest first
+            prefixes = ''.join(s for s in self.prefix_symbols if s in prefixes or s == symbol)
+        channel.members[key] = sys.intern(prefixes)
+
+    def split_prefixes(self, name):
+        # '@+nick' -> ('@+', 'nick')
+        i = 0
+        while i < len(name) and name[i] in self.prefix_symbols:
+            i += 1
+        return name[:i], name[i:]
+
+    def list_entries(self, channel_name, mode):
+        channel = self.channel(channel_name)
+        if channel is None:
+            return None
+        return channel.lists.setdefault(mode, OrderedDict())
+
+    def set_list(self, channel_name, mode, entries):
+        # a fetched list, masks set while it was being fetched are kept
+        channel = self.channel(channel_name)
+        if channel is None:
+            return
+        current = channel.lists.get(mode, {})
+        fetched = OrderedDict(sorted(entries.items(), key=lambda item: item[1][1]))
+        for mask, info in current.items():
+            fetched.setdefault(mask, info)
+        channel.lists[mode] = fetched
+        channel.known.add(mode)
+
+    def list_add(self, channel_name, mode, mask, setter, stamp=None):
+        entries = self.list_entries(channel_name, mode)
+        if entries is not None and mask not in entries:
+            entries[mask] = (setter, int(stamp or self.clock.time()))
+
+    def list_remove(self, channel_name, mode, mask):
+        entries = self.list_entries(channel_name, mode)
+        if entries is None:
+            return False
+        for key in entries:
+            if key.translate(self.lower) == mask.translate(self.lower):
+                del entries[key]
+                return True
+        return False
+
+    def clear(self):
+        self.users.clear()
+        self.channels.clear()
+
+
+class Request:
+    # A command waiting for its numeric replies, e.g. WHO collects the 352
+    # messages and is complete when 315 arrives. An error numeric only ends
+    # it when it names the request's target (channel or nick), and only
+    # replies that arrive after the line was written count.
+    def __init__(self, replies, end, future, errors=(), target=None):
+        self.replies = replies
+        self.end = end
+        self.future = future
+        self.errors = errors
+        self.target = target
+        self.written = False
+        self.lines = []
+
+
+class SendQueue:
+    # Every outgoing line goes through here. Lines are paced by a token
+    # bucket (flood_rate lines per second with bursts of flood_burst) so a
+    # mass kick or a netjoin does not get the bot killed for Excess Flood.
+    # PONG skips the pacing, MODE/KICK go before PRIVMSG and the rest. A line
+    # that is already queued is not queued again and a mode change replaces a
+    # queued opposite one for the same target (+o nick followed by -o nick).
+    # A line can carry callbacks that run when it is taken off to be written.
+    PONG, PROTECT, NORMAL = 0, 1, 2
+
+    def __init__(self, rate=1.0, burst=5, clock=time):
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = clock.monotonic()
+        self.lanes = (deque(), deque(), deque())
+        self.queued = {}
+        self.modes = {}
+        self.depth = 0
+        self.wakeup = asyncio.Event()
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+        # (line, seconds it spent in the queue) for the most recent lines
+        self.waits = deque(maxlen=256)
+
+    def lane_for(self, line):
+        command = line.split(' ', 1)[0].upper()
+        if command == 'PONG':
+            return self.PONG
+        if command == 'KICK':
+            return self.PROTECT
+        if command == 'MODE':
+            # changes go first, list queries ('MODE #chan b') wait their turn
+            parts = line.split(' ', 3)
+            if len(parts) > 2 and parts[2][:1] in ('+', '-'):
+                return self.PROTECT
+        return self.NORMAL
+
+    def mode_key(self, line):
+        # 'MODE #chan +o nick' -> ('#chan', 'o', 'nick'), None for anything else
+        parts = line.split(' ')
+        if len(parts) == 4 and parts[0] == 'MODE' and len(parts[2]) == 2 and parts[2][0] in '+-':
+            return parts[1].translate(RFC1459_LOWER), parts[2][1], parts[3].translate(RFC1459_LOWER)
+        return None
+
+    def put(self, line, lane=None, on_write=None):
+        queued = self.queued.get(line)
+        if queued is not None:
+            if on_write is not None:
+                queued[4].append(on_write)
+            return False
+        key = self.mode_key(line)
+        if key is not None:
+            superseded = self.modes.pop(key, None)
+            if superseded is not None:
+                self.drop(superseded)
+        entry = [line, self.clock.monotonic(), True, key, [on_write] if on_write is not None else []]
+        self.lanes[self.lane_for(line) if lane is None else lane].append(entry)
+        self.queued[line] = entry
+        if key is not None:
+            self.modes[key] = entry
+        self.depth += 1
+        self.wakeup.set()
+        return True
+
+    def drop(self, entry):
+        entry[2] = False
+        self.queued.pop(entry[0], None)
+        self.depth -= 1
+
+    def pop(self):
+        for lane in self.lanes:
+            while lane:
+                entry = lane.popleft()
+                if not entry[2]:
+                    continue
+                self.queued.pop(entry[0], None)
+                if entry[3] is not None and self.modes.get(entry[3]) is entry:
+                    del self.modes[entry[3]]
+                self.depth -= 1
+                wait = self.clock.monotonic() - entry[1]
+                self.last_wait = wait
+                self.max_wait = max(self.max_wait, wait)
+                self.waits.append((entry[0], wait))
+                for callback in entry[4]:
+                    callback()
+                return entry[0]
+        return None
+
+    def refill(self):
+        now = self.clock.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    async def get(self):
+        while True:
+            self.refill()
+            if self.lanes[self.PONG]:
+                self.tokens = max(self.tokens - 1, 0)
+                return self.pop()
+            if self.depth:
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return self.pop()
+                delay = (1 - self.tokens) / self.rate
+            else:
+                delay = None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+
+class JoinBatcher:
+    # JOINs are collected for join_window milliseconds and then matched
+    # against the fb lists in one go, so a netjoin ends up as a few grouped
+    # MODE/KICK lines per channel instead of separate lines for every user.
+    def __init__(self, conn, window):
+        self.conn = conn
+        self.window = window
+        self.pending = {}
+        self.timer = None
+
+    def add(self, channel, nick, userhost):
+        if not self.conn.bot.fb.lookup(self.conn.name, channel):
+            return
+        key = channel.translate(RFC1459_LOWER)
+        if key not in self.pending:
+            self.pending[key] = (channel, [])
+        self.pending[key][1].append((nick, userhost))
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, {}
+        for channel, users in pending.values():
+            enforce_fb(self.conn, channel, users)
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.pending = {}
+
+
+class FloodCounter:
+    # Events per key over the last `seconds`, estimated from the count of the
+    # current fixed window plus the previous one weighted by how much of it
+    # is still inside the sliding window. A hit is O(1) and a key is three
+    # numbers; idle keys are evicted oldest first past `size` keys.
+    def __init__(self, limit, seconds, size=4096, clock=time):
+        self.limit = limit
+        self.seconds = seconds
+        self.size = size
+        self.clock = clock
+        self.counts = OrderedDict()
+
+    def hit(self, key, now=None):
+        # counts one event, True once key is at or over the limit
+        now = self.clock.monotonic() if now is None else now
+        start = now - now % self.seconds
+        slot = self.counts.get(key)
+        if slot is None:
+            slot = self.counts[key] = [start, 0, 0]
+            if len(self.counts) > self.size:
+                self.counts.popitem(last=False)
+        else:
+            self.counts.move_to_end(key)
+            if slot[0] != start:
+                slot[1] = slot[2] if start - slot[0] <= self.seconds else 0
+                slot[0], slot[2] = start, 0
+        slot[2] += 1
+        return slot[1] * (1 - (now - start) / self.seconds) + slot[2] >= self.limit
+
+    def reset(self, key):
+        self.counts.pop(key, None)
+
+
+def flood_counter(config, key, default, clock=time):
+    # 'flood_join=8:4' is 8 events in 4 seconds, 0 turns the check off
+    value = config.get(key, default)
+    count, _, seconds = value.partition(':')
+    if not count.isdigit() or int(count) == 0:
+        return None
+    return FloodCounter(int(count), parse_duration(seconds) or float(seconds or 1), clock=clock)
+
+
+# 'irc.a.net irc.b.net', the quit message of a netsplit
+NETSPLIT_QUIT = re.compile(r'^[\w-]+(\.[\w-]+)+ [\w-]+(\.[\w-]+)+$')
+SPLIT_MEMORY = 4096
+
+
+class FloodGuard:
+    # Incoming flood checks for one connection: joins per channel (the
+    # channel is locked with flood_lock_modes), the same line repeated by
+    # one host on a channel and nick changes per host (kickban), and CTCPs
+    # per host (the host is ignored). Owners and fb friends are left alone.
+    # The join lock and the repeat check are off unless configured. Joins
+    # of a netjoin BATCH and of users who left in a netsplit in the last
+    # flood_split_time are not counted.
+    def __init__(self, conn):
+        config = conn.config
+        self.conn = conn
+        self.clock = clock = conn.bot.clock
+        self.joins = flood_counter(config, 'flood_join', '0', clock)
+        self.repeats = flood_counter(config, 'flood_repeat', '0', clock)
+        self.nicks = flood_counter(config, 'flood_nick', '4:30', clock)
+        self.ctcps = flood_counter(config, 'flood_ctcp', '4:30', clock)
+        self.lock_modes = config.get('flood_lock_modes', 'mi')
+        self.lock_time = parse_duration(config.get('flood_lock_time', '2m')) or 120
+        self.ban_time = parse_duration(config.get('flood_ban_time', '1h'))
+        self.ignore_time = parse_duration(config.get('flood_ignore_time', '10m')) or 600
+        self.split_time = parse_duration(config.get('flood_split_time', '30m')) or 1800
+        self.ignored = OrderedDict()
+        # nick!ident@host -> when it quit in a netsplit, oldest first
+        self.split = OrderedDict()
+
+    def join(self, channel, hostmask, netjoin=False):
+        if self.joins is None:
+            return
+        if netjoin or self.rejoined(hostmask):
+            return
+        if self.joins.hit(self.conn.state.key(channel)):
+            self.lock(channel)
+
+    def quit(self, hostmask, reason):
+        if self.joins is None or not NETSPLIT_QUIT.match(reason):
+            return
+        key = hostmask.translate(RFC1459_LOWER)
+        self.split[key] = self.clock.monotonic()
+        self.split.move_to_end(key)
+        if len(self.split) > SPLIT_MEMORY:
+            self.split.popitem(last=False)
+
+    def rejoined(self, hostmask):
+        # back from a netsplit, one join per channel it was on
+        split = self.split
+        now = self.clock.monotonic()
+        while split:
+            first = next(iter(split))
+            if now - split[first] < self.split_time:
+                break
+            del split[first]
+        return hostmask.translate(RFC1459_LOWER) in split
+
+    def message(self, nick, userhost, target, text):
+        # False when the line should not be looked at any further
+        host = userhost.rpartition('@')[2]
+        if self.ignored and self.is_ignored(host):
+            return False
+        if text.startswith('\x01') and not text.startswith('\x01ACTION '):
+            if self.ctcps is not None and self.ctcps.hit(host):
+                self.ctcps.reset(host)
+                if not self.exempt(None, nick, userhost):
+                    self.ignore(host)
+                    return False
+        elif self.repeats is not None and self.conn.state.channel(target):
+            key = (self.conn.state.key(target), host, text)
+            if self.repeats.hit(key):
+                self.repeats.reset(key)
+                self.kickban(target, nick, userhost, 'Flood')
+        return True
+
+    def nick_change(self, nick, userhost):
+        # nick is the new nick
+        if self.nicks is None:
+            return
+        host = userhost.rpartition('@')[2]
+        if self.nicks.hit(host):
+            self.nicks.reset(host)
+            key = self.conn.state.key(nick)
+            for channel in list(self.conn.state.channels.values()):
+                if key in channel.members:
+                    self.kickban(channel.name, nick, userhost, 'Nick flood')
+
+    def is_ignored(self, host):
+        until = self.ignored.get(host)
+        if until is None:
+            return False
+        if until > self.clock.monotonic():
+            return True
+        del self.ignored[host]
+        return False
+
+    def ignore(self, host):
+        log_action.warning(f"{self.conn.label}Ignoring {host} for {self.ignore_time}s (CTCP flood)")
+        self.ignored.pop(host, None)
+        self.ignored[host] = self.clock.monotonic() + self.ignore_time
+        if len(self.ignored) > 1024:
+            self.ignored.popitem(last=False)
+
+    def exempt(self, channel, nick, userhost):
+        hostmask = nick + '!' + userhost
+        if is_owner(hostmask, self.conn.bot.owners):
+            return True
+        if channel is None:
+            return False
+        for index in self.conn.bot.fb.lookup(self.conn.name, channel):
+            matches = index.match(hostmask)
+            if matches:
+                return matches[0][1] == 'f'
+        return False
+
+    def kickban(self, channel, nick, userhost, reason):
+        conn = self.conn
+        if not bot_is_op(conn, channel) or self.exempt(channel, nick, userhost):
+            return
+        if not conn.bot.link.mine(conn, channel, userhost.rpartition('@')[2].lower()):
+            return
+        log_action.info('%s%s: kickban %s!%s (%s)', conn.label, channel, nick, userhost, reason)
+        for line in ban_lines(conn, channel, ['*!*' + userhost], seconds=self.ban_time):
+            conn.send(line)
+        for line in kick_lines(channel, [nick], reason, conn.isupport):
+            conn.send(line)
+
+    def lock(self, channel):
+        conn = self.conn
+        if not self.lock_modes or not bot_is_op(conn, channel):
+            return
+        if not conn.bot.link.mine(conn, channel, conn.state.key(channel)):
+            return
+        if conn.bot.scheduler.find('unlock', conn.name, channel, self.lock_modes):
+            return
+        log_action.warning(f"{conn.label}Join flood on {channel}, setting +{self.lock_modes} for {self.lock_time}s")
+        conn.send('MODE ' + channel + ' +' + self.lock_modes)
+        conn.bot.scheduler.schedule(self.lock_time, 'unlock', conn.name, channel, self.lock_modes)
+
+
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    # Fixed buckets (upper bounds in seconds) allocated up front, so an
+    # observation is a bisect and three additions.
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # upper bound of the bucket the q-th observation falls in
+        if not self.count:
+            return None
+        wanted = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    # Counters and histograms of one connection. Everything the per-line path
+    # touches exists before the first line comes in; the event loop is the
+    # only writer, so nothing needs a lock.
+    def __init__(self, commands):
+        self.lines_in = dict.fromkeys(commands, 0)
+        self.lines_out = dict.fromkeys(('PRIVMSG', 'MODE', 'KICK', 'JOIN', 'PONG', 'PING', 'WHO', 'NICK'), 0)
+        self.dispatch = {command: Histogram() for command in commands}
+        self.dispatch['numeric'] = Histogram()
+        self.mask_match = Histogram()
+        self.queue_wait = Histogram()
+        self.lag = Histogram()
+        self.last_lag = None
+        self.reconnects = 0
+
+    def dispatched(self, command, seconds):
+        histogram = self.dispatch.get(command)
+        if histogram is None:
+            histogram = self.dispatch[command] = Histogram()
+        histogram.observe(seconds)
+
+
+def metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_histogram(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(histogram.bounds, histogram.counts):
+        cumulative += count
+        lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+    lines.append(f'{name}_sum{{{labels}}} {histogram.sum:.6f}')
+    lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+
+def format_metrics(bot):
+    # the Prometheus text format
+    conns = [(f'network="{metric_label(name)}"', conn) for name, conn in bot.connections.items()]
+    lines = []
+    for name, kind, help_text in (('protogen_lines_in_total', 'counter', 'IRC lines received per command'),
+                                  ('protogen_lines_out_total', 'counter', 'IRC lines sent per command')):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for labels, conn in conns:
+            counts = conn.metrics.lines_in if name == 'protogen_lines_in_total' else conn.metrics.lines_out
+            for command, count in counts.items():
+                if count:
+                    lines.append(f'{name}{{{labels},command="{metric_label(command)}"}} {count}')
+    lines += ['# HELP protogen_dispatch_seconds Time spent in the handler of an incoming line',
+              '# TYPE protogen_dispatch_seconds histogram']
+    for labels, conn in conns:
+        for command, histogram in conn.metrics.dispatch.items():
+            if histogram.count:
+                format_histogram(lines, 'protogen_dispatch_seconds',
+                                 f'{labels},command="{metric_label(command)}"', histogram)
+    for name, attribute, help_text in (
+            ('protogen_mask_match_seconds', 'mask_match', 'Time to match one user against the fb masks'),
+            ('protogen_send_queue_wait_seconds', 'queue_wait', 'Time an outgoing line spent in the send queue'),
+            ('protogen_lag_seconds', 'lag', 'Server round trip time measured with PING')):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for labels, conn in conns:
+            format_histogram(lines, name, labels, getattr(conn.metrics, attribute))
+    gauges = (
+        ('protogen_send_queue_depth', 'gauge', 'Lines waiting in the send queue',
+         lambda conn: conn.send_queue.depth if conn.send_queue is not None else 0),
+        ('protogen_connected', 'gauge', 'Whether the network is connected',
+         lambda conn: int(conn.writer is not None)),
+        ('protogen_channels', 'gauge', 'Channels the bot is on', lambda conn: len(conn.state.channels)),
+        ('protogen_reconnects_total', 'counter', 'Reconnects after a lost link', lambda conn: conn.metrics.reconnects),
+    )
+    for name, kind, help_text, value in gauges:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+        for labels, conn in conns:
+            lines.append(f'{name}{{{labels}}} {value(conn)}')
+    lines += ['# HELP protogen_timers Pending scheduled actions', '# TYPE protogen_timers gauge',
+              f'protogen_timers {len(bot.scheduler)}',
+              '# HELP protogen_link_peers Linked bots', '# TYPE protogen_link_peers gauge',
+              f'protogen_link_peers {len(bot.link.peers)}',
+              '# HELP protogen_log_dropped_total Log lines dropped on a full log queue',
+              '# TYPE protogen_log_dropped_total counter',
+              f'protogen_log_dropped_total {log_handler.dropped if log_handler is not None else 0}']
+    return '\n'.join(lines) + '\n'
+
+
+async def serve_metrics(bot, reader, writer):
+    # just enough HTTP for a Prometheus scrape: any GET gets the metrics
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        if request.startswith(b'GET '):
+            body = format_metrics(bot).encode()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n\r\n' + body)
+        else:
+            writer.write(b'HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n')
+        await writer.drain()
+    except (OSError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+
+def format_stats(conn):
+    # .stats, a short summary of the same numbers
+    metrics = conn.metrics
+
+    def top(counts):
+        busiest = sorted(((count, command) for command, count in counts.items() if count), reverse=True)[:5]
+        return ', '.join(f"{command} {count}" for count, command in busiest) or 'none'
+
+    def ms(value):
+        return 'n/a' if value is None else f"{value * 1000:.2f} ms"
+
+    dispatch = Histogram()
+    for histogram in metrics.dispatch.values():
+        dispatch.counts = [a + b for a, b in zip(dispatch.counts, histogram.counts)]
+        dispatch.count += histogram.count
+    depth = conn.send_queue.depth if conn.send_queue is not None else 0
+    return [
+        f"{conn.label}In: {sum(metrics.lines_in.values())} lines ({top(metrics.lines_in)})",
+        f"{conn.label}Out: {sum(metrics.lines_out.values())} lines ({top(metrics.lines_out)})",
+        f"{conn.label}Dispatch p50 {ms(dispatch.quantile(0.5))}, p99 {ms(dispatch.quantile(0.99))}; "
+        f"mask match p99 {ms(metrics.mask_match.quantile(0.99))}",
+        f"{conn.label}Send queue {depth} lines, wait p99 {ms(metrics.queue_wait.quantile(0.99))}; "
+        f"lag {ms(metrics.last_lag)}; reconnects {metrics.reconnects}",
+    ]
+
+
+class Capture:
+    # Raw traffic of every connection for replay, one
+    # '<unix time> <'<' in or '>' out> <network> <line>' per line. Writes go
+    # to a large buffer flushed once a second; at capture_size bytes the
+    # file is rotated to path.1.gz (compressed in a background thread) and
+    # older ones move up to path.<capture_keep>.gz.
+    def __init__(self, path, size, keep):
+        self.path = path
+        self.size = size
+        self.keep = keep
+        self.file = open(path, 'a', buffering=1 << 20, errors='replace')
+        self.written = self.file.tell()
+        self.handle = None
+
+    def start(self):
+        self.handle = asyncio.get_running_loop().call_later(1, self.tick)
+
+    def tick(self):
+        self.file.flush()
+        self.start()
+
+    def record(self, direction, network, line):
+        entry = f"{time.time():.3f} {direction} {network} {line}\n"
+        self.file.write(entry)
+        self.written += len(entry)
+        if self.written >= self.size:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        for number in range(self.keep - 1, 0, -1):
+            older = f"{self.path}.{number}.gz"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{number + 1}.gz")
+        rotated = self.path + '.1'
+        os.replace(self.path, rotated)
+        threading.Thread(target=compress_file, args=(rotated,), daemon=True).start()
+        self.file = open(self.path, 'a', buffering=1 << 20, errors='replace')
+        self.written = 0
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+        self.file.close()
+
+
+def compress_file(path):
+    with open(path, 'rb') as source, gzip.open(path + '.gz', 'wb') as target:
+        shutil.copyfileobj(source, target)
+    os.remove(path)
+
+
+def open_capture(config):
+    if not config.get('capture'):
+        return None
+    size = int(float(config.get('capture_size', 10)) * 1024 * 1024)
+    return Capture(config['capture'], size, int(config.get('capture_keep', 5)))
+
+
+CONNECT_TIMEOUT = 30
+REGISTER_TIMEOUT = 60
+STABLE_LINK = 60
+
+
+class ServerPool:
+    # The servers of one network with a smoothed round trip time for each,
+    # measured by lag PINGs on the live link and TCP connect probes on the
+    # others. None marks a server whose last probe failed.
+    smoothing = 0.3
+
+    def __init__(self, servers):
+        self.servers = list(servers)
+        self.rtt = {}
+
+    def update(self, server, rtt):
+        old = self.rtt.get(server)
+        if old is None or rtt is None:
+            self.rtt[server] = rtt
+        else:
+            self.rtt[server] = old + self.smoothing * (rtt - old)
+
+    def ranked(self, exclude=None):
+        # fastest first, then the unmeasured ones in config order, failed last
+        def key(server):
+            if server not in self.rtt:
+                return 1, 0
+            rtt = self.rtt[server]
+            return (2, 0) if rtt is None else (0, rtt)
+        return sorted((server for server in self.servers if server != exclude), key=key)
+
+
+async def probe_server(server, config):
+    # TCP connect time, None if the server does not answer
+    start = time.monotonic()
+    try:
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(server[0], server[1], **connect_options(config)), CONNECT_TIMEOUT)
+    except (OSError, asyncio.TimeoutError):
+        return None
+    rtt = time.monotonic() - start
+    writer.close()
+    return rtt
+
+
+WELCOME_NUMERICS = ('001', '002', '003', '004', '005', '376', '422')
+
+
+class Standby:
+    # A second link, registered under another nick and kept idle: it only
+    # answers PINGs. Taking it over skips connecting and registering, the
+    # welcome lines are replayed to the new owner so ISUPPORT is known and
+    # the channels get joined.
+    def __init__(self, conn, server, reader, writer, nick, lines, caps):
+        self.conn = conn
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.nick = nick
+        self.lines = lines
+        self.caps = caps
+        self.welcome = []
+        self.task = asyncio.create_task(self.idle())
+
+    @property
+    def alive(self):
+        return self.task is not None and not self.task.done()
+
+    async def idle(self):
+        try:
+            while True:
+                while self.lines.pending:
+                    line = self.lines.pending.popleft()
+                    msg = parse_message(line)
+                    if msg is None:
+                        continue
+                    if msg.command == 'PING':
+                        self.writer.write(('PONG :' + msg.param(0, '') + '\r\n').encode())
+                    elif msg.command in WELCOME_NUMERICS:
+                        self.welcome.append(line)
+                    elif msg.command == 'ERROR':
+                        return
+                data = await self.reader.read(4096)
+                if not data:
+                    return
+                self.lines.feed(data)
+        except OSError:
+            return
+
+    def take(self):
+        self.task.cancel()
+        self.task = None
+        self.lines.pending.extendleft(reversed(self.welcome))
+        return self.reader, self.writer, self.lines, self.server, self.nick, self.caps
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.writer.write(b'QUIT :Standby closed\r\n')
+        self.writer.close()
+
+
+class IRCConnection:
+    # One link to an IRC server. The reader task handles every incoming line
+    # (PING is answered right there), the writer task sends queued lines and
+    # commands that need a server reply await it with request().
+    def __init__(self, bot, config):
+        self.bot = bot
+        self.config = config
+        self.name = config['name']
+        self.servers = config['servers']
+        self.server = None
+        self.nick = config['nick']
+        self.nicks_used = {self.nick}
+        self.channels = {}
+        for channel in config['channels']:
+            self.remember(channel)
+        self.reader = None
+        self.writer = None
+        self.lines = None
+        self.send_queue = None
+        self.requests = []
+        self.isupport = ISupport()
+        self.state = StateTracker(bot.clock)
+        self.joins = JoinBatcher(self, int(config.get('join_window', 200)) / 1000)
+        self.flood = FloodGuard(self)
+        self.handlers = {
+            'PING': self.on_ping,
+            'PONG': self.on_pong,
+            'JOIN': self.on_join,
+            'PART': self.on_part,
+            'KICK': self.on_kick,
+            'QUIT': self.on_quit,
+            'NICK': self.on_nick,
+            'MODE': self.on_mode,
+            'PRIVMSG': self.on_privmsg,
+            '001': self.on_welcome,
+            '005': self.on_isupport,
+            '376': self.on_motd_end,
+            '422': self.on_motd_end,
+            '353': self.on_names,
+            '366': self.on_names_end,
+            'CAP': self.on_cap,
+            'CHGHOST': self.on_chghost,
+            'ACCOUNT': self.on_account,
+            'AWAY': self.on_away,
+            'BATCH': self.on_batch,
+        }
+        self.metrics = Metrics(self.handlers)
+        self.tasks = set()
+        self.read_task = None
+        self.write_task = None
+        self.closed = asyncio.Event()
+        self.pool = ServerPool(self.servers)
+        self.tls = None
+        self.standby = None
+        self.lag_sent = None
+        self.lag_token = None
+        # IRCv3 capabilities of the current link and its open BATCHes
+        self.caps = set()
+        self.batches = {}
+
+    @property
+    def label(self):
+        # prefix for console output once there is more than one network
+        return f"[{self.name}] " if len(self.bot.connections) > 1 else ''
+
+    def remember(self, channel):
+        self.channels[channel.translate(RFC1459_LOWER)] = channel
+
+    def forget(self, channel):
+        self.channels.pop(channel.translate(RFC1459_LOWER), None)
+
+    async def run(self):
+        # Keeps the network connected. Reconnects wait a random time of up to
+        # reconnect_delay * 2^attempt seconds (capped at reconnect_max), and
+        # the attempt counter starts over once a link has stayed up a while.
+        base = float(self.config.get('reconnect_delay', 2))
+        cap = float(self.config.get('reconnect_max', 300))
+        attempt = 0
+        try:
+            self.tls = tls_context(self.config)
+        except OSError as e:
+            log_conn.warning(f"{self.label}Unable to set up TLS: {e}")
+            return
+        self.spawn(self.maintain())
+        while True:
+            try:
+                await self.connect()
+            except ValueError as e:
+                report_connect_error(self.config, e, self.label)
+                self.cancel_tasks()
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                # every server was reported by connect(), a bad bind_ip
+                # is reported once here and stops this network
+                if bind_failed(self.config, e):
+                    report_connect_error(self.config, e, self.label)
+                    log_conn.error(f"{self.label}Not reconnecting, fix bind_ip in config.txt and restart.")
+                    self.cancel_tasks()
+                    return
+            else:
+                started = time.monotonic()
+                await self.closed.wait()
+                if time.monotonic() - started > STABLE_LINK:
+                    attempt = 0
+                if self.standby is not None and self.standby.alive:
+                    log_conn.info(f"{self.label}Switching to the standby link on {self.standby.server[0]}")
+                    continue
+            delay = random.uniform(0, min(cap, base * 2 ** attempt))
+            attempt += 1
+            self.metrics.reconnects += 1
+            log_conn.info(f"{self.label}Reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def connect(self, server=None):
+        # Takes over the standby link if it goes to the wanted server (or no
+        # server was asked for). Otherwise opens and registers a new link to
+        # the given (host, port), or to the fastest server of the pool that
+        # answers, and only then replaces the current link. The last error
+        # is raised if none works.
+        standby = self.standby
+        if standby is not None and standby.alive and server in (None, standby.server):
+            self.standby = None
+            self.adopt(*standby.take())
+            return
+        error = None
+        for host, port in [server] if server else self.pool.ranked():
+            try:
+                reader, writer, nick, lines, caps = await self.open_link((host, port), self.config['nick'])
+            except (OSError, asyncio.TimeoutError) as e:
+                if bind_failed(self.config, e):
+                    raise
+                error = e
+                report_connect_error(self.config, e, self.label, (host, port))
+                continue
+            self.adopt(reader, writer, lines, (host, port), nick, caps)
+            return
+        raise error
+
+    async def open_link(self, server, nick):
+        # a registered link, its TCP connect time goes into the pool
+        start = time.monotonic()
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(server[0], server[1], ssl=self.tls, **connect_options(self.config)),
+                CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            self.pool.update(server, None)
+            raise
+        self.pool.update(server, time.monotonic() - start)
+        try:
+            nick, lines, caps = await asyncio.wait_for(self.register(reader, writer, nick), REGISTER_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            writer.close()
+            raise
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            # session tickets have arrived by now, keep one for next time
+            if ssl_object.session is not None:
+                self.tls.sessions[server[0]] = ssl_object.session
+            log_conn.info(f"{self.label}{ssl_object.version()} {'resumed' if ssl_object.session_reused else 'full handshake'} with {server[0]}")
+        return reader, writer, nick, lines, caps
+
+    async def register(self, reader, writer, nick):
+        # NICK/USER on a fresh link, read up to 001. The 001 and whatever
+        # came after it stay in the returned LineReader for the read loop.
+        # The IRCv3 capabilities the server offers from CAPABILITIES are
+        # requested first, and with sasl_mechanism set SASL is done through
+        # CAP as well. A server without CAP ignores it and registers us anyway.
+        # Returns the nick, the LineReader and the capabilities we got.
+        tries = 0
+        lines = LineReader()
+        mechanism = self.config.get('sasl_mechanism', '').upper()
+        offered = set()
+        caps = set()
+        if mechanism or config_flag(self.config, 'caps', '1'):
+            writer.write(b'CAP LS 302\r\n')
+        writer.write(f"NICK {nick}\r\nUSER {self.config['nick']} 0 * :{self.config.get('realname', self.config['nick'])}\r\n".encode())
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                raise ConnectionError('Connection closed during registration')
+            lines.feed(data)
+            while lines.pending:
+                msg = parse_message(lines.pending[0])
+                if msg is not None and msg.command == '001':
+                    return nick, lines, caps
+                line = lines.pending.popleft()
+                if self.bot.capture is not None:
+                    self.bot.capture.record('<', self.name, line)
+                log_raw.info('%s%s', self.label, line)
+                if msg is None:
+                    continue
+                if msg.command == 'PING':
+                    writer.write(('PONG :' + msg.param(0, '') + '\r\n').encode())
+                elif msg.command in ('432', '433', '437'):
+                    # the nick is still held by our old link (or a ghost)
+                    tries += 1
+                    nick = alt_nick(self.config['nick'], tries)
+                    writer.write(('NICK ' + nick + '\r\n').encode())
+                elif msg.command == 'CAP' and len(msg.params) > 2:
+                    subcommand, names = msg.params[1], msg.params[-1].split()
+                    if subcommand == 'LS':
+                        offered.update(name.partition('=')[0] for name in names)
+                        if msg.params[2] == '*' and len(msg.params) > 3:
+                            continue  # more LS lines to come
+                        wanted = wanted_caps(self.config, offered, mechanism)
+                        if mechanism and 'sasl' not in wanted:
+                            log_conn.warning(f"{self.label}Server does not support SASL, continuing without it.")
+                        if wanted:
+                            writer.write(('CAP REQ :' + ' '.join(wanted) + '\r\n').encode())
+                        else:
+                            writer.write(b'CAP END\r\n')
+                    elif subcommand == 'ACK':
+                        caps.update(names)
+                        if 'sasl' in names:
+                            writer.write(('AUTHENTICATE ' + mechanism + '\r\n').encode())
+                        else:
+                            writer.write(b'CAP END\r\n')
+                    elif subcommand == 'NAK':
+                        log_conn.warning(f"{self.label}Server refused capabilities {' '.join(names)}, continuing without them.")
+                        writer.write(b'CAP END\r\n')
+                elif msg.command == 'AUTHENTICATE' and msg.param(0) == '+':
+                    for line in sasl_lines(mechanism, self.config):
+                        writer.write((line + '\r\n').encode())
+                elif msg.command == '903':
+                    writer.write(b'CAP END\r\n')
+                elif msg.command in ('902', '904', '905', '906', '907', '908'):
+                    log_conn.warning(f"{self.label}SASL {mechanism} failed, continuing without it.")
+                    writer.write(b'CAP END\r\n')
+                elif msg.command == 'ERROR':
+                    raise ConnectionError(msg.param(0, 'ERROR'))
+
+    def adopt(self, reader, writer, lines, server, nick, caps=()):
+        # Switch to a registered link. An old link is only dropped here,
+        # after its replacement is up.
+        old = self.writer
+        tasks = (self.read_task, self.write_task)
+        self.read_task = self.write_task = None
+        for task in tasks:
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self.fail_requests()
+        self.joins.cancel()
+        if old is not None:
+            old.write(b'QUIT :Jumping to new server\r\n')
+            old.close()
+        self.reader, self.writer, self.lines = reader, writer, lines
+        self.server = server
+        self.nick = nick
+        self.nicks_used.add(nick)
+        self.caps = set(caps)
+        self.batches = {}
+        self.send_queue = SendQueue(float(self.config.get('flood_rate', 1)), int(self.config.get('flood_burst', 5)),
+                                    self.bot.clock)
+        self.isupport = ISupport()
+        self.state.clear()
+        self.closed.clear()
+        self.lag_sent = None
+        self.read_task = asyncio.create_task(self.read_loop())
+        self.write_task = asyncio.create_task(self.write_loop())
+        if nick != self.config['nick']:
+            self.spawn(self.regain_nick())
+        if self.standby is not None and self.standby.server == server:
+            # no point in a standby on the server we are on now
+            self.standby.close()
+            self.standby = None
+
+    async def maintain(self):
+        # Every lag_interval seconds: a timestamped PING on the live link (a
+        # link that has not answered the previous one for lag_timeout seconds
+        # is dropped), TCP connect probes against the other servers every
+        # probe_interval seconds and, with standby=1, a standby link to the
+        # fastest other server. The settings are read every round, so a
+        # config.txt reload changes them.
+        next_probe = 0
+        while True:
+            await asyncio.sleep(float(self.config.get('lag_interval', 30)))
+            if self.writer is None:
+                continue
+            lag_timeout = float(self.config.get('lag_timeout', 120))
+            probe_interval = float(self.config.get('probe_interval', 300))
+            want_standby = config_flag(self.config, 'standby')
+            now = time.monotonic()
+            if self.lag_sent is None:
+                self.lag_sent = now
+                self.lag_token = f"LAG{now:.6f}"
+                self.send_queue.put('PING :' + self.lag_token, SendQueue.PONG)
+            elif now - self.lag_sent > lag_timeout:
+                log_conn.warning(f"{self.label}No PONG for {now - self.lag_sent:.0f}s, dropping the link.")
+                await self.drop()
+                continue
+            if now >= next_probe:
+                next_probe = now + probe_interval
+                others = self.pool.ranked(exclude=self.server)
+                results = await asyncio.gather(*(probe_server(server, self.config) for server in others))
+                for server, rtt in zip(others, results):
+                    self.pool.update(server, rtt)
+            if want_standby and (self.standby is None or not self.standby.alive):
+                await self.open_standby()
+
+    async def open_standby(self):
+        candidates = self.pool.ranked(exclude=self.server) or self.pool.servers
+        nick = self.config.get('standby_nick') or alt_nick(self.config['nick'], 1)
+        for server in candidates:
+            if server in self.pool.rtt and self.pool.rtt[server] is None:
+                continue
+            try:
+                reader, writer, nick, lines, caps = await self.open_link(server, nick)
+            except (OSError, asyncio.TimeoutError) as e:
+                report_connect_error(self.config, e, self.label, server)
+                if bind_failed(self.config, e):
+                    return
+                continue
+            if self.standby is not None:
+                self.standby.close()
+            self.standby = Standby(self, server, reader, writer, nick, lines, caps)
+            log_conn.info(f"{self.label}Standby link up on {server[0]}:{server[1]} as {nick}")
+            return
+
+    async def drop(self):
+        # give up on a link that stopped answering, run() takes it from here
+        await self.close()
+        self.closed.set()
+
+    async def regain_nick(self):
+        # after a jump the old link may hold the nick a little longer
+        for delay in (1, 2, 5, 10):
+            await asyncio.sleep(delay)
+            if self.writer is None or self.state.key(self.nick) == self.state.key(self.config['nick']):
+                return
+            self.send('NICK ' + self.config['nick'])
+
+    async def close(self):
+        self.joins.cancel()
+        tasks = (self.read_task, self.write_task)
+        self.read_task = self.write_task = None
+        for task in tasks:
+            if task is not None and task is not asyncio.current_task():
+                task.cancel()
+        self.fail_requests()
+        self.lag_sent = None
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.writer = None
+
+    def reconfigure(self, config):
+        # Takes a reloaded config.txt section without reconnecting. Servers,
+        # TLS, SASL and bind_ip are only used by the next connect.
+        old, self.config = self.config, config
+        changed = sorted(key for key in set(old) | set(config) if old.get(key) != config.get(key))
+        if not changed:
+            return
+        log.info(f"{self.label}config.txt changed: {', '.join(changed)}")
+        if 'servers' in changed:
+            self.servers = config['servers']
+            pool = ServerPool(self.servers)
+            pool.rtt = {server: rtt for server, rtt in self.pool.rtt.items() if server in self.servers}
+            self.pool = pool
+        if any(key == 'tls' or key.startswith('tls_') for key in changed):
+            try:
+                self.tls = tls_context(config)
+            except OSError as e:
+                log_conn.warning(f"{self.label}Unable to set up TLS: {e}")
+        if 'nick' in changed and self.writer is not None:
+            self.send('NICK ' + config['nick'])
+        if 'channels' in changed:
+            wanted = {channel.translate(RFC1459_LOWER): channel for channel in config['channels']}
+            dropped = {channel.translate(RFC1459_LOWER): channel for channel in old['channels']}
+            for key in wanted.keys() & dropped.keys():
+                del wanted[key], dropped[key]
+            for channel in dropped.values():
+                self.forget(channel)
+                self.send('PART ' + channel + ' :' + 'Arrivederci roma')
+            for channel in wanted.values():
+                self.remember(channel)
+            for line in join_lines(list(wanted.values()), self.isupport):
+                self.send(line)
+        if any(key.startswith('flood_') and key not in ('flood_rate', 'flood_burst') for key in changed):
+            ignored = self.flood.ignored
+            self.flood = FloodGuard(self)
+            self.flood.ignored = ignored
+        if self.send_queue is not None and ('flood_rate' in changed or 'flood_burst' in changed):
+            self.send_queue.rate = float(config.get('flood_rate', 1))
+            self.send_queue.burst = int(config.get('flood_burst', 5))
+            self.send_queue.tokens = min(self.send_queue.tokens, self.send_queue.burst)
+        if 'join_window' in changed:
+            self.joins.window = int(config.get('join_window', 200)) / 1000
+
+    def cancel_tasks(self):
+        # maintain() and the other helpers, when the network is given up
+        for task in list(self.tasks):
+            task.cancel()
+
+    async def retire(self, reason):
+        # the network was taken out of config.txt
+        self.cancel_tasks()
+        if self.standby is not None:
+            self.standby.close()
+            self.standby = None
+        if self.writer is not None:
+            self.writer.write(f"QUIT :{reason}\r\n".encode())
+        await self.close()
+
+    def send(self, line):
+        if self.send_queue is not None:
+            self.send_queue.put(line)
+
+    async def request(self, line, replies, end, timeout=10, errors=()):
+        # The timeout starts when the line is written, not when it is queued:
+        # on join the WHOs and list queries of every channel wait their turn
+        # behind the flood pacing. A lost link completes the request early.
+        # None when one of the errors numerics came back for the target.
+        if self.send_queue is None:
+            return []
+        loop = asyncio.get_running_loop()
+        target = line.split(' ')[1] if errors and ' ' in line else None
+        request = Request(replies, end, loop.create_future(), errors,
+                          self.state.key(target) if target else None)
+        written = loop.create_future()
+
+        def on_write():
+            request.written = True
+            if not written.done():
+                written.set_result(None)
+        self.requests.append(request)
+        self.send_queue.put(line, on_write=on_write)
+        try:
+            await asyncio.wait((written, request.future), return_when=asyncio.FIRST_COMPLETED)
+            return await asyncio.wait_for(asyncio.shield(request.future), timeout)
+        except asyncio.TimeoutError:
+            return request.lines
+        finally:
+            written.cancel()
+            if request in self.requests:
+                self.requests.remove(request)
+
+    def fail_requests(self):
+        for request in self.requests:
+            if not request.future.done():
+                request.future.set_result(request.lines)
+        self.requests = []
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+        return task
+
+    def task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log_command.error(f"Command failed: {task.exception()!r}")
+
+    async def write_loop(self):
+        while True:
+            line = await self.send_queue.get()
+            metrics = self.metrics
+            metrics.queue_wait.observe(self.send_queue.last_wait)
+            command = line.split(' ', 1)[0]
+            metrics.lines_out[command] = metrics.lines_out.get(command, 0) + 1
+            if self.bot.capture is not None:
+                self.bot.capture.record('>', self.name, line)
+            log_raw.debug('%s>> %s', self.label, line)
+            self.writer.write((line + '\r\n').encode())
+            await self.writer.drain()
+
+    async def read_loop(self):
+        try:
+            while True:
+                # lines left over from registration come first
+                while self.lines.pending:
+                    message = self.lines.pending.popleft()
+                    log_raw.info('%s%s', self.label, message)
+                    if self.bot.capture is not None:
+                        self.bot.capture.record('<', self.name, message)
+                    msg = self.handle_line(message)
+                    if msg is not None and msg.command == 'ERROR':
+                        log_conn.warning(f"{self.label}Connection closed by server with message: {message}")
+                        return
+                data = await self.reader.read(4096)
+                if not data:
+                    log_conn.warning(f"{self.label}Connection closed by server.")
+                    break
+                self.lines.feed(data)
+        except OSError as e:
+            log_conn.warning(f"{self.label}An error occurred: {e}")
+        finally:
+            # a cancelled reader belongs to a link that was closed on purpose
+            if asyncio.current_task() is self.read_task:
+                await self.close()
+                self.closed.set()
+
+    def handle_line(self, line):
+        msg = parse_message(line)
+        if msg is None:
+            return None
+        command = msg.command
+        metrics = self.metrics
+        metrics.lines_in[command] = metrics.lines_in.get(command, 0) + 1
+        handler = self.handlers.get(command)
+        start = time.perf_counter()
+        if handler is not None:
+            handler(msg)
+            metrics.dispatched(command, time.perf_counter() - start)
+        elif command.isdigit():
+            self.handle_reply(msg)
+            metrics.dispatch['numeric'].observe(time.perf_counter() - start)
+        return msg
+
+    def on_ping(self, msg):
+        self.send('PONG :' + msg.param(0, ''))
+
+    def on_pong(self, msg):
+        if self.lag_sent is not None and msg.params and msg.params[-1] == self.lag_token:
+            lag = time.monotonic() - self.lag_sent
+            self.pool.update(self.server, lag)
+            self.metrics.lag.observe(lag)
+            self.metrics.last_lag = lag
+            self.lag_sent = None
+
+    def on_join(self, msg):
+        if not msg.host or not msg.params:
+            return
+        state = self.state
+        channel = msg.params[0]
+        if state.key(msg.nick) == state.key(self.nick):
+            self.remember(channel)
+            state.add_channel(channel)
+            # with userhost-in-names the NAMES reply has everything WHO would
+            if 'userhost-in-names' not in self.caps:
+                self.spawn(self.sync_channel(channel))
+        else:
+            state.add_member(channel, msg.nick, msg.user, msg.host)
+            if len(msg.params) > 1 and 'extended-join' in self.caps:
+                user = state.user(msg.nick)
+                if user is not None:
+                    user.account = msg.params[1] if msg.params[1] != '*' else None
+            netjoin = bool(msg.raw_tags) and self.batches.get(msg.tags.get('batch')) == 'netjoin'
+            self.flood.join(channel, msg.prefix, netjoin)
+            self.joins.add(channel, msg.nick, msg.user + '@' + msg.host)
+
+    def on_part(self, msg):
+        if not msg.params:
+            return
+        if self.state.key(msg.nick) == self.state.key(self.nick):
+            self.forget(msg.params[0])
+            self.state.remove_channel(msg.params[0])
+        else:
+            self.state.remove_member(msg.params[0], msg.nick)
+
+    def on_kick(self, msg):
+        if len(msg.params) < 2:
+            return
+        channel, victim = msg.params[0], msg.params[1]
+        if self.state.key(victim) == self.state.key(self.nick):
+            self.state.remove_channel(channel)
+        else:
+            self.state.remove_member(channel, victim)
+
+    def on_quit(self, msg):
+        if msg.host:
+            self.flood.quit(msg.prefix, msg.param(0, ''))
+        self.state.quit(msg.nick)
+        self.nick_freed(msg.nick)
+
+    def on_nick(self, msg):
+        if not msg.params:
+            return
+        new_nick = msg.params[0]
+        self.state.rename(msg.nick, new_nick)
+        if self.state.key(msg.nick) == self.state.key(self.nick):
+            self.nick = new_nick
+            self.nicks_used.add(new_nick)
+        else:
+            self.nick_freed(msg.nick)
+            if msg.host:
+                self.flood.nick_change(new_nick, msg.user + '@' + msg.host)
+
+    def nick_freed(self, nick):
+        # take our configured nick back as soon as whoever held it lets go
+        wanted = self.state.key(self.config['nick'])
+        if self.state.key(nick) == wanted and self.state.key(self.nick) != wanted:
+            self.send('NICK ' + self.config['nick'])
+
+    def on_mode(self, msg):
+        state = self.state
+        params = msg.params
+        if len(params) < 3 or not state.channel(params[0]):
+            return
+        channel = params[0]
+        for adding, mode, arg in parse_modes(params[1], params[2:], state.prefix_modes, state.chanmodes):
+            if mode in state.prefix_modes and arg:
+                state.set_prefix(channel, arg, mode, adding)
+                if mode == 'o' and adding and state.key(arg) == state.key(self.nick):
+                    self.spawn(self.fetch_lists(channel, 'eI'))
+                    self.spawn(sweep_channel(self, channel))
+            elif mode in state.chanmodes[0] and arg:
+                if adding:
+                    state.list_add(channel, mode, arg, msg.prefix)
+                else:
+                    state.list_remove(channel, mode, arg)
+
+    def on_privmsg(self, msg):
+        if not msg.host or len(msg.params) < 2:
+            return
+        text = msg.params[1]
+        if not self.flood.message(msg.nick, msg.user + '@' + msg.host, msg.params[0], text):
+            return
+        # plain chatter never gets near the command table
+        if text.startswith('.'):
+            dispatch_command(self, msg.prefix, msg.params[0], text)
+
+    def on_welcome(self, msg):
+        if msg.params:
+            self.nick = msg.params[0]
+            self.nicks_used.add(self.nick)
+        self.handle_reply(msg)
+
+    def on_motd_end(self, msg):
+        # ISUPPORT is known by now, rejoin everything from our own list
+        for line in join_lines(list(self.channels.values()), self.isupport):
+            self.send(line)
+        self.handle_reply(msg)
+
+    def on_isupport(self, msg):
+        self.isupport.update(msg.params[1:-1])
+        self.state.set_isupport(self.isupport)
+        self.handle_reply(msg)
+
+    def on_names(self, msg):
+        # '@+nick' per user, all the prefixes with multi-prefix and
+        # '@nick!ident@host' with userhost-in-names
+        params = msg.params
+        if len(params) > 3:
+            for name in params[3].split():
+                prefixes, name = self.state.split_prefixes(name)
+                nick, _, userhost = name.partition('!')
+                ident, _, host = userhost.partition('@')
+                self.state.add_member(params[2], nick, ident, host if ident else None, prefixes)
+        self.handle_reply(msg)
+
+    def on_names_end(self, msg):
+        tracked = self.state.channel(msg.param(1, ''))
+        if 'userhost-in-names' in self.caps and tracked is not None and not tracked.synced.is_set():
+            self.spawn(self.channel_synced(tracked.name))
+        self.handle_reply(msg)
+
+    def on_cap(self, msg):
+        # CAP on a registered link: cap-notify NEW/DEL and our later REQs
+        if len(msg.params) < 3:
+            return
+        subcommand, names = msg.params[1], msg.params[-1].split()
+        if subcommand == 'ACK':
+            for name in names:
+                if name.startswith('-'):
+                    self.caps.discard(name[1:])
+                else:
+                    self.caps.add(name)
+        elif subcommand == 'DEL':
+            self.caps.difference_update(names)
+        elif subcommand == 'NEW':
+            wanted = [cap for cap in wanted_caps(self.config, {name.partition('=')[0] for name in names})
+                      if cap not in self.caps]
+            if wanted:
+                self.send('CAP REQ :' + ' '.join(wanted))
+
+    def on_chghost(self, msg):
+        # a new ident@host is checked against the fb lists like a join
+        user = self.state.user(msg.nick)
+        if user is None or len(msg.params) < 2:
+            return
+        self.state.set_host(user, msg.params[0], msg.params[1])
+        key = self.state.key(user.nick)
+        if key == self.state.key(self.nick):
+            return
+        for channel in self.state.channels.values():
+            if key in channel.members:
+                self.joins.add(channel.name, user.nick, user.ident + '@' + user.host)
+
+    def on_account(self, msg):
+        user = self.state.user(msg.nick)
+        if user is not None and msg.params:
+            user.account = msg.params[0] if msg.params[0] != '*' else None
+
+    def on_away(self, msg):
+        user = self.state.user(msg.nick)
+        if user is not None:
+            user.away = msg.param(0)
+
+    def on_batch(self, msg):
+        # the JOINs of a netjoin batch are enforced as soon as it ends
+        # instead of after join_window
+        if not msg.params:
+            return
+        reference = msg.params[0]
+        if reference.startswith('+'):
+            self.batches[reference[1:]] = msg.param(1)
+        elif self.batches.pop(reference[1:], None) == 'netjoin':
+            self.joins.flush()
+
+    def handle_reply(self, msg):
+        # hand numeric replies to whoever is waiting for them
+        numeric = msg.command
+        for request in self.requests:
+            if request.future.done() or not request.written:
+                continue
+            if numeric in request.errors:
+                if self.state.key(msg.param(1, '')) == request.target:
+                    request.future.set_result(None)
+                    break
+                continue
+            if numeric in request.replies:
+                request.lines.append(msg)
+                break
+            if numeric in request.end:
+                request.future.set_result(request.lines)
+                break
+
+    async def sync_channel(self, channel):
+        # One WHO per channel on join fills in ident@host and status for
+        # everybody, everything after that comes from channel events.
+        state = self.state
+        if 'WHOX' in self.isupport:
+            lines = await self.request(f'WHO {channel} %tuhnaf,{WHOX_TOKEN}', ('354',), ('315',))
+        else:
+            lines = await self.request('WHO ' + channel, ('352',), ('315',))
+        for msg in lines:
+            numeric, params = msg.command, msg.params
+            if numeric == '354' and len(params) > 5 and params[1] == WHOX_TOKEN:
+                ident, host, nick, flags = params[2:6]
+            elif numeric == '352' and len(params) > 6 and state.key(params[1]) == state.key(channel):
+                ident, host, nick, flags = params[2], params[3], params[5], params[6]
+            else:
+                continue
+            prefixes = ''.join(s for s in flags if s in state.prefix_symbols)
+            state.add_member(channel, nick, ident, host, prefixes)
+        await self.channel_synced(channel)
+
+    async def channel_synced(self, channel):
+        # everybody on channel has a host now, by WHO or by NAMES
+        synced = self.state.channel(channel)
+        if synced is not None:
+            synced.synced.set()
+        # exception and invite lists are usually only shown to ops
+        await self.fetch_lists(channel, 'beI' if bot_is_op(self, channel) else 'b')
+
+    async def fetch_lists(self, channel, modes):
+        # ban/exception/invex lists, once per join
+        for mode in modes:
+            tracked = self.state.channel(channel)
+            if tracked is None or mode in tracked.known or mode not in self.state.chanmodes[0]:
+                continue
+            reply, end = LIST_REPLIES[mode]
+            lines = await self.request(f'MODE {channel} {mode}', (reply,), (end,), errors=('482',))
+            if lines is None:
+                continue  # not shown to us, the list stays unknown
+            entries = {}
+            for msg in lines:
+                params = msg.params
+                if len(params) > 2 and self.state.key(params[1]) == self.state.key(channel):
+                    stamp = int(params[4]) if len(params) > 4 and params[4].isdigit() else 0
+                    entries[params[2]] = (params[3] if len(params) > 3 else '', stamp)
+            self.state.set_list(channel, mode, entries)
+
+
+def listen_address(address):
+    # 'unix:/path/to/socket' or 'host:port'
+    if address.startswith('unix:'):
+        return address[5:], None
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def shard_weight(name, key):
+    return hashlib.blake2b(f"{name} {key}".encode(), digest_size=8).digest()
+
+
+class LinkPeer:
+    # One link to another protoGen instance: JSON objects, one per line.
+    # Both sides open with a hello carrying a random nonce and prove they
+    # know link_secret with an HMAC over the other side's nonce; nothing
+    # else is accepted before that.
+    def __init__(self, link, reader, writer, outgoing):
+        self.link = link
+        self.reader = reader
+        self.writer = writer
+        self.outgoing = outgoing
+        self.name = None
+        self.nonce = os.urandom(16).hex()
+        self.authed = False
+        self.ops = set()
+        self.last_seen = time.monotonic()
+
+    def send(self, message):
+        if not self.writer.is_closing():
+            self.writer.write((json.dumps(message, separators=(',', ':')) + '\n').encode())
+
+    def mac(self, nonce, name):
+        return hmac.new(self.link.secret.encode(), f"{nonce} {name}".encode(), 'sha256').hexdigest()
+
+    def close(self):
+        self.writer.close()
+
+    async def run(self):
+        self.send({'type': 'hello', 'name': self.link.name, 'nonce': self.nonce})
+        try:
+            while True:
+                line = await asyncio.wait_for(self.reader.readline(), self.link.timeout * 4 if not self.authed else None)
+                if not line:
+                    break
+                self.last_seen = time.monotonic()
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(message, dict):
+                    continue
+                if not self.authed:
+                    if not self.handshake(message):
+                        break
+                else:
+                    self.link.handle(self, message)
+        except (OSError, asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            self.close()
+            self.link.lost(self)
+
+    def handshake(self, message):
+        kind = message.get('type')
+        if kind == 'hello' and self.name is None:
+            self.name = str(message.get('name', ''))
+            if not self.name or self.name == self.link.name:
+                log_link.warning(f"Link: refusing peer named {self.name!r}")
+                return False
+            self.send({'type': 'auth', 'mac': self.mac(message.get('nonce', ''), self.link.name)})
+            return True
+        if kind == 'auth' and self.name is not None:
+            if not hmac.compare_digest(str(message.get('mac', '')), self.mac(self.nonce, self.name)):
+                log_link.warning(f"Link: {self.name} failed authentication")
+                return False
+            self.authed = True
+            return self.link.joined(self)
+        return False
+
+
+class BotLink:
+    # Links between protoGen instances guarding the same channels. Linked
+    # bots pass on owner and fb changes made through commands, tell each
+    # other where they have ops, and split the work: of the bots opped on a
+    # channel only the one that comes first in the rendezvous (highest
+    # random weight) hash of a key, such as the joining host, acts on it.
+    # A peer that closes its link or misses heartbeats for link_timeout
+    # seconds is dropped and its share goes to the others right away.
+    def __init__(self, bot, config):
+        self.bot = bot
+        self.name = config.get('link_name') or config.get('nick', '')
+        self.secret = config.get('link_secret', '')
+        self.listen = config.get('link_listen', '')
+        self.peer_addresses = [address for address in config.get('link_peers', '').replace(',', ' ').split()]
+        self.timeout = float(config.get('link_timeout', 1))
+        self.interval = self.timeout / 4
+        self.peers = {}
+        self.sent_ops = None
+        self.tasks = set()
+
+    @property
+    def enabled(self):
+        return bool(self.secret and (self.listen or self.peer_addresses))
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self):
+        if self.listen:
+            path, port = listen_address(self.listen)
+            try:
+                if port is None:
+                    await asyncio.start_unix_server(self.accept, path)
+                else:
+                    await asyncio.start_server(self.accept, path, port)
+            except (OSError, ValueError) as e:
+                log_link.warning(f"Link: unable to listen on {self.listen}: {e}")
+        for address in self.peer_addresses:
+            self.spawn(self.keep_linked(address))
+        while True:
+            await asyncio.sleep(self.interval)
+            self.heartbeat()
+
+    async def accept(self, reader, writer):
+        await LinkPeer(self, reader, writer, False).run()
+
+    async def keep_linked(self, address):
+        path, port = listen_address(address)
+        failed = False
+        while True:
+            try:
+                if port is None:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                else:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(path, port), CONNECT_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                if not failed:
+                    log_link.warning(f"Link: unable to reach {address}: {e}")
+                failed = True
+            else:
+                failed = False
+                await LinkPeer(self, reader, writer, True).run()
+            await asyncio.sleep(self.timeout)
+
+    def joined(self, peer):
+        # When two bots link to each other, both keep the link opened by
+        # the bot whose name sorts first.
+        current = self.peers.get(peer.name)
+        if current is not None:
+            first = min(self.name, peer.name)
+            if (self.name if peer.outgoing else peer.name) != first:
+                return False
+            self.peers.pop(peer.name)
+            current.close()
+        self.peers[peer.name] = peer
+        log_link.info(f"Link: {peer.name} linked")
+        peer.send({'type': 'ops', 'ops': self.ops()})
+        return True
+
+    def lost(self, peer):
+        if self.peers.get(peer.name) is not peer:
+            return
+        del self.peers[peer.name]
+        log_link.warning(f"Link: {peer.name} lost")
+        # users who joined while the peer was dying are checked again
+        for network, channel in peer.ops:
+            conn = self.bot.connections.get(network)
+            tracked = conn.state.channel(channel) if conn is not None else None
+            if tracked is not None and bot_is_op(conn, channel):
+                conn.spawn(sweep_channel(conn, tracked.name))
+
+    def ops(self):
+        return {name: [channel.name for channel in conn.state.channels.values() if bot_is_op(conn, channel.name)]
+                for name, conn in self.bot.connections.items()}
+
+    def heartbeat(self):
+        now = time.monotonic()
+        for peer in list(self.peers.values()):
+            if now - peer.last_seen > self.timeout:
+                peer.close()
+                self.lost(peer)
+        ops = self.ops()
+        message = {'type': 'ops', 'ops': ops} if ops != self.sent_ops else {'type': 'ping'}
+        self.sent_ops = ops
+        for peer in self.peers.values():
+            peer.send(message)
+
+    def mine(self, conn, channel, key):
+        # is this bot the one to act on key on channel
+        if not self.peers:
+            return True
+        target = (conn.name, conn.state.key(channel))
+        best = shard_weight(self.name, key)
+        for name, peer in self.peers.items():
+            if target in peer.ops and shard_weight(name, key) > best:
+                return False
+        return True
+
+    def publish(self, kind, **fields):
+        fields['type'] = kind
+        for peer in self.peers.values():
+            peer.send(fields)
+
+    def fb_entry(self, peer, fields):
+        # an fb entry from a peer, checked like a line of fb.txt
+        fields = [str(field) for field in fields]
+        entry = None
+        if len(fields) == 4 and not any(len(field.split()) > 1 for field in fields):
+            entry = parse_fb_line(' '.join(fields[:3]), network=fields[3])
+        if entry is None:
+            log_link.warning(f"Link: dropping invalid fb entry {fields!r} from {peer.name}")
+        return entry
+
+    def handle(self, peer, message):
+        kind = message.get('type')
+        bot = self.bot
+        try:
+            if kind == 'ops':
+                peer.ops = {(network, channel.translate(RFC1459_LOWER))
+                            for network, channels in message['ops'].items() for channel in channels}
+            elif kind == 'fb':
+                entry = self.fb_entry(peer, message['entry'])
+                if entry is None:
+                    return
+                channel, host, flag, network = entry
+                if message['op'] == 'add':
+                    until = message.get('until')
+                    add_fb(bot, channel, host, flag, network, max(1, until - time.time()) if until else None)
+                else:
+                    remove_fb(bot, channel, host, flag, network)
+            elif kind == 'fbimport':
+                entries = [self.fb_entry(peer, entry) for entry in message['entries']]
+                apply_fb_import(bot, bot.fb.add_many(entry for entry in entries if entry is not None))
+            elif kind == 'owner':
+                # checked like .+own, a bad mask would end up in owner.txt
+                mask = str(message['mask'])
+                if not OWNER_MASK.fullmatch(mask):
+                    log_link.warning(f"Link: dropping invalid owner mask {mask!r} from {peer.name}")
+                elif message['op'] == 'add':
+                    bot.owners.add((mask,))
+                else:
+                    bot.owners.remove((mask,))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            log_link.warning(f"Link: bad {kind} message from {peer.name}: {e!r}")
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def inotify_watch(directories):
+    # an inotify descriptor watching the directories, through libc, or None
+    # where there is no inotify
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    for directory in directories:
+        if libc.inotify_add_watch(fd, directory.encode(), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            os.close(fd)
+            return None
+    return fd
+
+
+class FileWatcher:
+    # Tells the bot when one of its files changed on disk. The directories
+    # are watched with inotify, since editors and compact() replace a file
+    # by renaming another over it and a watch on the file itself would go
+    # with the old inode. Without inotify the files are stat()ed every
+    # reload_interval seconds. A burst of changes ends up as one callback
+    # per file, reload_delay seconds after the last of them.
+    def __init__(self, paths, callback, interval=2.0, delay=0.5):
+        self.paths = {os.path.abspath(path): path for path in paths}
+        self.callback = callback
+        self.interval = interval
+        self.delay = delay
+        self.signatures = {path: file_signature(path) for path in self.paths}
+        self.changed = set()
+        self.timer = None
+        self.fd = None
+        self.poller = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self.fd = inotify_watch({os.path.dirname(path) for path in self.paths})
+        if self.fd is not None:
+            loop.add_reader(self.fd, self.on_events)
+        else:
+            log.info('No inotify, checking the files for changes every %ss', self.interval)
+            self.poller = loop.create_task(self.poll())
+
+    def close(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        if self.poller is not None:
+            self.poller.cancel()
+        if self.fd is not None:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def on_events(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        offset = 0
+        names = {os.path.basename(path): path for path in self.paths}
+        while offset + INOTIFY_EVENT.size <= len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            if name in names:
+                self.changed.add(names[name])
+        if self.changed:
+            self.schedule()
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for path in self.paths:
+                if file_signature(path) != self.signatures[path]:
+                    self.changed.add(path)
+            if self.changed:
+                self.schedule()
+
+    def schedule(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = asyncio.get_running_loop().call_later(self.delay, self.fire)
+
+    def fire(self):
+        self.timer = None
+        changed, self.changed = self.changed, set()
+        for path in changed:
+            signature = file_signature(path)
+            if signature is None or signature == self.signatures[path]:
+                continue
+            self.signatures[path] = signature
+            self.callback(self.paths[path])
+
+
+# settings only read at startup
+RESTART_KEYS = ('link_', 'metrics_', 'capture', 'reload', 'log_file', 'log_format', 'log_max_size',
+                'log_rotate', 'log_keep', 'log_queue', 'log_console')
+
+
+class Bot:
+    # State shared by the whole bot: configuration, owners and fb lists, and
+    # one IRCConnection per network, all served by the same event loop.
+    def __init__(self, config, owners, fb, timers, clock=time):
+        # clock is the time module, or a ReplayClock in a replay
+        self.clock = clock
+        self.config = config
+        self.owners = owners
+        self.fb = fb
+        self.scheduler = Scheduler(self, timers)
+        self.link = BotLink(self, config)
+        self.capture = open_capture(config)
+        self.connections = {}
+        for name, network in network_configs(config).items():
+            self.connections[name] = IRCConnection(self, network)
+        self.runners = {}
+        self.tasks = set()
+        self.watcher = None
+
+    def connections_for(self, network=''):
+        # every connection an fb entry of this network applies to
+        if not network:
+            return list(self.connections.values())
+        conn = self.connections.get(network)
+        return [conn] if conn is not None else []
+
+    async def run(self):
+        self.scheduler.start()
+        if self.capture is not None:
+            self.capture.start()
+        for conn in self.connections.values():
+            self.start(conn)
+        if self.link.enabled:
+            self.runners[None] = asyncio.create_task(self.link.run())
+        if self.config.get('metrics_listen'):
+            await self.serve_metrics(self.config['metrics_listen'])
+        if config_flag(self.config, 'reload', '1'):
+            self.watcher = FileWatcher(('config.txt', self.owners.path, self.fb.path), self.reload,
+                                       float(self.config.get('reload_interval', 2)))
+            self.watcher.start()
+        # networks come and go with config.txt, the bot runs while any does
+        while self.runners:
+            done, pending = await asyncio.wait(set(self.runners.values()), return_when=asyncio.FIRST_COMPLETED)
+            for name, task in list(self.runners.items()):
+                if task in done:
+                    del self.runners[name]
+                    if not task.cancelled():
+                        task.result()
+
+    def start(self, conn):
+        self.runners[conn.name] = asyncio.create_task(conn.run())
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def reload(self, path):
+        try:
+            if path == 'config.txt':
+                self.reload_config()
+            elif path == self.owners.path:
+                self.reload_owners()
+            elif path == self.fb.path:
+                self.reload_fb()
+        except (OSError, ValueError) as e:
+            log.error(f"Unable to reload {path}: {e}")
+
+    def reload_owners(self):
+        if file_signature(self.owners.path) == self.owners.signature:
+            return  # our own compact()
+        added, removed = self.owners.reload()
+        for entry in added:
+            self.link.publish('owner', op='add', mask=entry[0])
+        for entry in removed:
+            self.link.publish('owner', op='remove', mask=entry[0])
+        log.info(f"Reloaded {self.owners.path}: {len(added)} owners added, {len(removed)} removed")
+
+    def reload_fb(self):
+        if file_signature(self.fb.path) == self.fb.signature:
+            return
+        added, removed = self.fb.reload()
+        for entry in removed:
+            fb_removed(self, *entry)
+            self.link.publish('fb', op='remove', entry=list(entry))
+        # only the channels with new 'd' entries are swept
+        apply_fb_import(self, added)
+        if added:
+            self.link.publish('fbimport', entries=[list(entry) for entry in added])
+        log.info(f"Reloaded {self.fb.path}: {len(added)} fb entries added, {len(removed)} removed")
+
+    def reload_config(self):
+        # Applies what changed in config.txt to the running bot. Networks
+        # are added and removed, the others reconfigured on their live link.
+        config = load_config()
+        changed = sorted(key for key in set(self.config) | set(config)
+                         if key != 'networks' and self.config.get(key) != config.get(key))
+        self.config = config
+        log_levels(config)
+        restart = [key for key in changed if key.startswith(RESTART_KEYS)]
+        if restart:
+            log.warning(f"config.txt: {', '.join(restart)} only change after a restart")
+        networks = network_configs(config)
+        if not networks:
+            log.warning('config.txt has no usable network, keeping the current ones')
+            return
+        for name, conn in list(self.connections.items()):
+            if name not in networks:
+                log.info(f"Leaving network {name}, it is no longer in config.txt")
+                runner = self.runners.pop(name, None)
+                if runner is not None:
+                    runner.cancel()
+                del self.connections[name]
+                self.spawn(conn.retire('Network removed'))
+        for name, network in networks.items():
+            conn = self.connections.get(name)
+            if conn is None:
+                log.info(f"Connecting to network {name}, new in config.txt")
+                conn = self.connections[name] = IRCConnection(self, network)
+                self.start(conn)
+            else:
+                conn.reconfigure(network)
+
+    async def serve_metrics(self, address):
+        path, port = listen_address(address)
+        handler = functools.partial(serve_metrics, self)
+        try:
+            if port is None:
+                await asyncio.start_unix_server(handler, path)
+            else:
+                await asyncio.start_server(handler, path, port)
+        except (OSError, ValueError) as e:
+            log.error(f"Unable to serve metrics on {address}: {e}")
+
+
+COMMANDS = {}
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plugins')
+missing_plugins = set()
+
+
+class Command:
+    # A registered command: who may use it, how many arguments it takes
+    # (the last one gets the rest of the line) and how often one host may
+    # call it (rate = (calls, seconds)).
+    def __init__(self, name, handler, owner, args, rate, usage):
+        self.name = name
+        self.handler = handler
+        self.owner = owner
+        self.min_args, self.max_args = args
+        self.rate = rate
+        self.usage = usage or name
+        self.calls = OrderedDict()
+
+    def split(self, text):
+        if self.max_args is None:
+            return text.split()[1:]
+        return text.split(None, self.max_args)[1:]
+
+    def allowed(self, host, now=None):
+        # sliding window per host, idle hosts are forgotten oldest first
+        if self.rate is None:
+            return True
+        count, seconds = self.rate
+        now = time.monotonic() if now is None else now
+        calls = self.calls.pop(host, None) or deque()
+        while calls and now - calls[0] > seconds:
+            calls.popleft()
+        self.calls[host] = calls
+        if len(self.calls) > 1024:
+            self.calls.popitem(last=False)
+        if len(calls) >= count:
+            return False
+        calls.append(now)
+        return True
+
+
+def command(name, owner=True, args=(0, 0), rate=None, usage=None):
+    # Registers an async handler(ctx, args) for a '.command'.
+    def register(handler):
+        COMMANDS[name] = Command(name, handler, owner, args, rate, usage)
+        return handler
+    return register
+
+
+def load_plugin(name):
+    # '.foo' is looked up in plugins/foo.py the first time somebody uses it.
+    # Plugins register their commands with protoGen.command.
+    plugin = name[1:]
+    if name in missing_plugins or not plugin.isidentifier():
+        return None
+    path = os.path.join(PLUGIN_DIR, plugin + '.py')
+    if not os.path.isfile(path):
+        missing_plugins.add(name)
+        return None
+    sys.modules.setdefault('protoGen', sys.modules[__name__])
+    spec = importlib.util.spec_from_file_location('protoGen_plugin_' + plugin, path)
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    except Exception as e:
+        log.error(f"Unable to load plugin {path}: {e!r}")
+        missing_plugins.add(name)
+        return None
+    if name not in COMMANDS:
+        missing_plugins.add(name)
+    return COMMANDS.get(name)
+
+
+class CommandContext:
+    def __init__(self, conn, sender, target, text):
+        self.conn = conn
+        self.bot = conn.bot
+        self.sender = sender
+        self.nick = sender.split('!')[0]
+        self.channel = target
+        self.text = text
+
+    def reply(self, line):
+        self.conn.send('PRIVMSG ' + self.nick + ' :' + line)
+
+
+def dispatch_command(conn, sender, target, text):
+    name = text.split(' ', 1)[0]
+    cmd = COMMANDS.get(name)
+    owner = None
+    if cmd is None:
+        # only owners get to trigger a plugin lookup on disk
+        owner = is_owner(sender, conn.bot.owners)
+        if not owner:
+            return
+        cmd = load_plugin(name)
+        if cmd is None:
+            return
+    if cmd.owner and not (owner if owner is not None else is_owner(sender, conn.bot.owners)):
+        return
+    ctx = CommandContext(conn, sender, target, text)
+    if not cmd.allowed(sender.split('@', 1)[-1], conn.bot.clock.monotonic()):
+        return
+    args = cmd.split(text)
+    if len(args) < cmd.min_args or (cmd.max_args is not None and len(args) > cmd.max_args):
+        ctx.reply('Usage: ' + cmd.usage)
+        return
+    log_command.info('%s%s from %s in %s', conn.label, name, sender, target)
+    conn.spawn(cmd.handler(ctx, args))
+
+
+@command('.op', args=(1, None), usage='.op nick [nick ...]')
+async def cmd_op(ctx, args):
+    for line in mode_lines(ctx.channel, '+', 'o', args, ctx.conn.isupport):
+        ctx.conn.send(line)
+
+
+@command('.deop', args=(1, None), usage='.deop nick [nick ...]')
+async def cmd_deop(ctx, args):
+    for line in mode_lines(ctx.channel, '-', 'o', args, ctx.conn.isupport):
+        ctx.conn.send(line)
+
+
+@command('.+own', args=(1, 1), usage='.+own *!ident@host')
+@command('.-own', args=(1, 1), usage='.-own *!ident@host')
+@command('.own')
+async def cmd_owner(ctx, args):
+    owners = ctx.bot.owners
+    mask = ctx.text.split(' ')[1] if ' ' in ctx.text else ''
+    had = (mask,) in owners
+    response = handle_owner_command(ctx.text, ctx.sender, owners)
+    if mask and ((mask,) in owners) != had:
+        ctx.bot.link.publish('owner', op='remove' if had else 'add', mask=mask)
+    if response:
+        for line in response.split('\n'):
+            ctx.reply(line)
+
+
+@command('.k', args=(1, 2), usage='.k nick [reason]')
+async def cmd_kick(ctx, args):
+    nick_to_kick = args[0]
+    kick_reason = args[1] if len(args) > 1 else 'Proton Has You'
+
+    # Check if nick_to_kick is in the channel
+    member = ctx.conn.state.member(ctx.channel, nick_to_kick)
+    if member:
+        ctx.conn.send('KICK ' + ctx.channel + ' ' + member[0].nick + ' :' + kick_reason)
+
+
+@command('.kb', args=(1, 2), usage='.kb nick [time] [reason]')
+async def cmd_kickban(ctx, args):
+    conn, channel = ctx.conn, ctx.channel
+    nick_to_kickban = args[0]
+    kick_reason = args[1] if len(args) > 1 else 'Proton Has You'
+    # an optional ban time comes first: '.kb nick 30m reason'
+    first, _, rest = kick_reason.partition(' ')
+    ban_time = parse_duration(first)
+    if ban_time:
+        kick_reason = rest.strip() or 'Proton Has You'
+
+    # Check if nick_to_kickban is in the channel
+    member = conn.state.member(channel, nick_to_kickban)
+    if member:
+        user = member[0]
+        if user.host is None:
+            await resolve_host(conn, user.nick)
+        if user.host is not None:
+            if '~' in user.ident:
+                ban_mask = '*!*@' + user.host
+            else:
+                ban_mask = '*!*' + user.ident + '@' + user.host
+            for line in ban_lines(conn, channel, [ban_mask], seconds=ban_time):
+                conn.send(line)
+        conn.send('KICK ' + channel + ' ' + user.nick + ' :' + kick_reason)
+
+
+@command('.mk')
+async def cmd_masskick(ctx, args):
+    nicks = [user.nick for user, prefixes in mass_targets(ctx.conn, ctx.channel, ctx.nick)]
+    for line in kick_lines(ctx.channel, nicks, 'protoGen Mass Kick', ctx.conn.isupport):
+        ctx.conn.send(line)
+
+
+@command('.mop')
+async def cmd_massop(ctx, args):
+    state = ctx.conn.state
+    nicks = [user.nick for user, prefixes in mass_targets(ctx.conn, ctx.channel, ctx.nick)
+             if not state.has_mode(prefixes, 'o')]
+    for line in mode_lines(ctx.channel, '+', 'o', nicks, ctx.conn.isupport):
+        ctx.conn.send(line)
+
+
+@command('.mdeop')
+async def cmd_massdeop(ctx, args):
+    state = ctx.conn.state
+    nicks = [user.nick for user, prefixes in mass_targets(ctx.conn, ctx.channel, ctx.nick)
+             if state.has_mode(prefixes, 'o')]
+    for line in mode_lines(ctx.channel, '-', 'o', nicks, ctx.conn.isupport):
+        ctx.conn.send(line)
+
+
+@command('.mban')
+async def cmd_massban(ctx, args):
+    masks = []
+    for user, prefixes in mass_targets(ctx.conn, ctx.channel, ctx.nick):
+        if user.host is not None:
+            mask = '*!*@' + user.host
+            if mask not in masks:
+                masks.append(mask)
+    limit = ctx.conn.isupport.list_limit('b')
+    if limit is not None:
+        masks = masks[:limit]
+    for line in ban_lines(ctx.conn, ctx.channel, masks):
+        ctx.conn.send(line)
+
+
+@command('.+fb', args=(3, 5), usage='.+fb #channel *!ident@host flag [network] [time]')
+async def cmd_add_fb(ctx, args):
+    network, expires = '', None
+    for arg in args[3:]:
+        if parse_duration(arg):
+            expires = parse_duration(arg)
+        else:
+            network = arg
+    entry = parse_fb_line(' '.join(args[:3]), network=network)
+    if entry is not None:
+        fb_channel, host, flag, network = entry
+        if add_fb(ctx.bot, fb_channel, host, flag, network, expires):
+            ctx.bot.link.publish('fb', op='add', entry=[fb_channel, host, flag, network],
+                                 until=time.time() + expires if expires else None)
+            ctx.reply('Added ' + fb_channel + ' to fb list.')
+        else:
+            ctx.reply('fb entry already exists.')
+    else:
+        ctx.reply('Incorrect data format. Please use the following format: #channel *!ident@host flag (' +
+                  ' or '.join(FB_FLAGS) + ')')
+
+
+@command('.-fb', args=(3, 4), usage='.-fb #channel *!ident@host flag [network]')
+async def cmd_remove_fb(ctx, args):
+    fb_channel, host, flag = args[:3]
+    network = args[3] if len(args) > 3 else ''
+    if fb_channel.startswith('#') and "!" in host:
+        if remove_fb(ctx.bot, fb_channel, host, flag, network):
+            ctx.bot.link.publish('fb', op='remove', entry=[fb_channel, host, flag, network])
+            ctx.reply('Removed ' + fb_channel + ' from fb list.')
+        else:
+            ctx.reply('fb entry not found.')
+    else:
+        ctx.reply('Incorrect data format. Please use the following format: #channel *!ident@host flag')
+
+
+def fb_filter(args):
+    # '[#channel] [network]' in any order
+    channel = network = None
+    for arg in args:
+        if arg.startswith('#'):
+            channel = arg
+        else:
+            network = arg
+    return channel, network
+
+
+@command('.fb', args=(0, 2), usage='.fb [#channel] [network]')
+async def cmd_list_fb(ctx, args):
+    for line in format_fb(ctx.bot.fb, *fb_filter(args)):
+        ctx.reply(line)
+
+
+@command('.fbimport', args=(1, 4), usage='.fbimport file [#channel flag [network]]')
+async def cmd_import_fb(ctx, args):
+    if len(args) == 2:
+        ctx.reply('Usage: .fbimport file [#channel flag [network]]')
+        return
+    try:
+        with open(args[0], 'r', errors='replace') as f:
+            added, duplicates, invalid = import_fb(ctx.bot.fb, f, *args[1:])
+    except OSError as e:
+        ctx.reply(f'Unable to read {args[0]}: {e.strerror}')
+        return
+    apply_fb_import(ctx.bot, added)
+    if added:
+        ctx.bot.link.publish('fbimport', entries=[list(entry) for entry in added])
+    ctx.reply(f'Imported {len(added)} fb entries ({duplicates} duplicates, {invalid} invalid).')
+
+
+@command('.fbexport', args=(1, 3), usage='.fbexport file [#channel] [network]')
+async def cmd_export_fb(ctx, args):
+    # only a plain file name, written to fb_export_dir
+    name = args[0]
+    directory = ctx.bot.config.get('fb_export_dir', 'exports')
+    if name != os.path.basename(name) or name.startswith('.'):
+        ctx.reply(f'Please give a plain file name, exports are written to {directory}.')
+        return
+    path = os.path.join(directory, name)
+    count = 0
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            for line in export_fb(ctx.bot.fb, *fb_filter(args[1:])):
+                f.write(line + '\n')
+                count += 1
+    except OSError as e:
+        ctx.reply(f'Unable to write {path}: {e.strerror}')
+        return
+    ctx.reply(f'Exported {count} fb entries to {path}.')
+
+
+@command('.join', args=(1, 1), usage='.join #channel')
+async def cmd_join(ctx, args):
+    ctx.conn.remember(args[0])
+    ctx.conn.send('JOIN ' + args[0])
+
+
+@command('.part', args=(1, 1), usage='.part #channel')
+async def cmd_part(ctx, args):
+    ctx.conn.forget(args[0])
+    ctx.conn.send('PART ' + args[0] + ' :' + 'Arrivederci roma')
+
+
+@command('.lc')
+async def cmd_list_channels(ctx, args):
+    # the tracked channels, WHOIS only before the bot is on any
+    channel_list = [channel.name for channel in ctx.conn.state.channels.values()]
+    if not channel_list:
+        channel_list = await whois_channels(ctx.conn, ctx.conn.nick)
+    if channel_list:
+        ctx.reply('Channels: ' + ' '.join(channel_list))
+        log_command.info(f"Sent channel list to {ctx.sender}")
+    else:
+        ctx.reply('Unable to retrieve channel list.')
+        log_command.warning(f"Unable to retrieve channel list for {ctx.sender}")
+
+
+@command('.jump', args=(0, 1), rate=(1, 30), usage='.jump [server[:port]]')
+async def cmd_jump(ctx, args):
+    target = args[0] if args else 'another server'
+    try:
+        await jump_server(ctx.conn, args[0] if args else None)
+    except (OSError, ValueError, asyncio.TimeoutError) as e:
+        ctx.reply(f'Unable to jump to {target}: {e}')
+
+
+@command('.servers')
+async def cmd_servers(ctx, args):
+    for line in format_servers(ctx.conn):
+        ctx.reply(line)
+
+
+@command('.stats', args=(0, 1), usage='.stats [network]')
+async def cmd_stats(ctx, args):
+    conns = ctx.bot.connections_for(args[0]) if args else [ctx.conn]
+    if not conns:
+        ctx.reply('Unknown network ' + args[0])
+    for conn in conns:
+        for line in format_stats(conn):
+            ctx.reply(line)
+
+
+def get_address_family(ip):
+    try:
+        socket.inet_pton(socket.AF_INET, ip)
+        return socket.AF_INET
+    except socket.error:
+        try:
+            socket.inet_pton(socket.AF_INET6, ip)
+            return socket.AF_INET6
+        except socket.error:
+            return None
+
+def connect_options(config):
+    # Extra open_connection() arguments. IPv4 and IPv6 addresses of a server
+    # are tried in parallel (Happy Eyeballs), limited to the family of
+    # bind_ip when the bot has to connect from a given address.
+    options = {'happy_eyeballs_delay': 0.25, 'interleave': 1}
+    if config.get('bind_ip'):
+        address_family = get_address_family(config['bind_ip'])
+        if address_family is None:
+            raise ValueError("Invalid IP address in configuration.")
+        options['family'] = address_family
+        options['local_addr'] = (config['bind_ip'], 0)
+    return options
+
+
+class ResumingContext(ssl.SSLContext):
+    # Offers the last TLS session of a server on the next handshake with it,
+    # so reconnects and .jump resume the session instead of doing a full
+    # handshake. asyncio has no way to pass a session, it does call
+    # wrap_bio() for every connection.
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and not server_side:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+
+def tls_context(config):
+    # None when the network does not use TLS
+    if not config_flag(config, 'tls'):
+        return None
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.sessions = {}
+    if not config_flag(config, 'tls_verify', '1'):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif config.get('tls_ca'):
+        context.load_verify_locations(config['tls_ca'])
+    else:
+        context.load_default_certs()
+    if config.get('tls_cert'):
+        # client certificate, for CertFP and SASL EXTERNAL
+        context.load_cert_chain(config['tls_cert'], config.get('tls_key') or None)
+    return context
+
+
+CAPABILITIES = ('multi-prefix', 'userhost-in-names', 'extended-join', 'chghost', 'account-notify',
+                'away-notify', 'batch', 'message-tags')
+
+
+def wanted_caps(config, offered, mechanism=''):
+    # what to CAP REQ out of what the server offers, caps=0 turns IRCv3 off
+    wanted = [cap for cap in CAPABILITIES if cap in offered] if config_flag(config, 'caps', '1') else []
+    if mechanism and 'sasl' in offered:
+        wanted.append('sasl')
+    return wanted
+
+
+def sasl_lines(mechanism, config):
+    # AUTHENTICATE lines with the base64 payload in 400 byte chunks, a
+    # payload that fills the last chunk exactly is followed by '+'
+    if mechanism == 'PLAIN':
+        username = config.get('sasl_username') or config['nick']
+        payload = f"{username}\0{username}\0{config.get('sasl_password', '')}"
+        encoded = base64.b64encode(payload.encode()).decode()
+    else:
+        encoded = ''
+    lines = ['AUTHENTICATE ' + encoded[i:i + 400] for i in range(0, len(encoded), 400)]
+    if len(encoded) % 400 == 0:
+        lines.append('AUTHENTICATE +')
+    return lines
+
+
+def alt_nick(nick, tries):
+    if tries == 1:
+        return nick + '_'
+    return nick[:6] + str(random.randint(100, 999))
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Never waits: when the queue is full the record is dropped and counted,
+    # and the next record that fits is preceded by a note of how many went.
+    # Records are formatted by the writer thread, not here.
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.reported = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            if self.dropped != self.reported:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    'name': 'protoGen.bot', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': '%d log lines dropped, the log writer is behind',
+                    'args': (self.dropped - self.reported,)}))
+                self.reported = self.dropped
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogFileHandler(logging.handlers.RotatingFileHandler):
+    # rotates at log_max_size bytes and every log_rotate seconds, whichever
+    # comes first
+    def __init__(self, path, max_bytes, interval, keep):
+        super().__init__(path, maxBytes=max_bytes, backupCount=keep, encoding='utf-8', errors='replace')
+        self.interval = interval
+        self.rollover_at = time.time() + interval if interval else None
+
+    def shouldRollover(self, record):
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+class LogFormatter(logging.Formatter):
+    # 'text' is 'time level category message', 'json' one object per line
+    def __init__(self, style):
+        super().__init__('%(asctime)s %(levelname)s %(category)s %(message)s')
+        self.style = style
+
+    def format(self, record):
+        record.category = record.name.rpartition('.')[2]
+        if self.style != 'json':
+            return super().format(record)
+        entry = {'time': round(record.created, 3), 'level': record.levelname.lower(),
+                 'category': record.category, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+log_handler = None
+
+
+def setup_logging(config):
+    # Everything the bot logs goes into a bounded queue (log_queue records)
+    # and a thread writes it to the console and/or log_file, so a slow
+    # terminal, pipe or disk never holds up the event loop. log_level and
+    # log_categories choose what is logged at all. Returns the listener,
+    # which has to be stopped to flush the queue.
+    global log_handler
+    handlers = []
+    if config_flag(config, 'log_console', '1'):
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter('%(message)s'))
+        handlers.append(console)
+    if config.get('log_file'):
+        interval = parse_duration(config.get('log_rotate', '')) or 0
+        max_bytes = int(float(config.get('log_max_size', 10)) * 1024 * 1024)
+        log_file = LogFileHandler(config['log_file'], max_bytes, interval, int(config.get('log_keep', 5)))
+        log_file.setFormatter(LogFormatter(config.get('log_format', 'text')))
+        handlers.append(log_file)
+    log_queue = queue.Queue(int(config.get('log_queue', 10000)))
+    log_handler = LogQueueHandler(log_queue)
+    root = logging.getLogger('protoGen')
+    root.handlers = [log_handler]
+    root.propagate = False
+    log_levels(config)
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return listener
+
+
+def log_levels(config):
+    # log_level and log_categories, also applied on a config.txt reload
+    logging.getLogger('protoGen').setLevel(getattr(logging, config.get('log_level', 'info').upper(), logging.INFO))
+    enabled = config.get('log_categories', ','.join(LOG_CATEGORIES)).replace(',', ' ').split()
+    for category in LOG_CATEGORIES:
+        logging.getLogger('protoGen.' + category).disabled = category not in enabled
+
+
+def bind_failed(config, e):
+    # bind_ip is not an address of this host, no server will do better
+    return bool(config.get('bind_ip')) and getattr(e, 'errno', None) == errno.EADDRNOTAVAIL
+
+
+def report_connect_error(config, e, label='', server=None):
+    if bind_failed(config, e):
+        log_conn.error(f"{label}Cannot assign requested address {config['bind_ip']}. Please use a valid IP address or 0.0.0.0 for localhost.")
+    elif server is not None:
+        log_conn.warning(f"{label}Unable to connect to {server[0]}:{server[1]}: {e or type(e).__name__}")
+    else:
+        log_conn.error(f"{label}An error occurred: {e}")
+
+
+def save_config(config):
+    with open('config.txt', 'w') as config_file:
+        for key, value in config.items():
+            config_file.write(f'{key}={value}\n')
+
+class ReplayClock:
+    # the bot's clock during a replay (Bot.clock is the time module
+    # otherwise), wall and monotonic time are both the capture's clock
+    def __init__(self, now, perf_counter):
+        self.now = now
+        self.perf_counter = perf_counter
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+
+class ReplayLoop(asyncio.SelectorEventLoop):
+    # timers run on the replay clock, so join_window, op_delay and timed bans
+    # fire at the captured times however fast the lines are fed
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def time(self):
+        return self.clock.now
+
+
+class ReplayReader:
+    # hands the captured lines to read_loop one at a time; a line counts as
+    # handled once read_loop asks for the next one
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.reading = False
+
+    async def read(self, size):
+        if self.reading:
+            self.queue.task_done()
+        self.reading = True
+        return await self.queue.get()
+
+
+class ReplayWriter:
+    # collects what the bot sends as (time, line)
+    def __init__(self, clock):
+        self.clock = clock
+        self.lines = []
+
+    def write(self, data):
+        now = self.clock.time()
+        for line in data.decode(errors='replace').split('\r\n'):
+            if line:
+                self.lines.append((now, line))
+
+    async def drain(self):
+        pass
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+
+def read_capture(paths, network=None):
+    # (time, network, line) of the received lines, in capture order
+    for path in paths:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', errors='replace') as f:
+            for entry in f:
+                fields = entry.rstrip('\n').split(' ', 3)
+                if len(fields) < 4 or fields[1] != '<':
+                    continue
+                if network is None:
+                    network = fields[2]
+                if fields[2] == network:
+                    yield float(fields[0]), fields[2], fields[3]
+
+
+async def replay_traffic(conn, records, speed, clock):
+    # Feeds the records to conn the way a server would. With a clock the
+    # lines go in as fast as they are handled and the clock jumps to each
+    # line's time; with speed the gaps are slept for real, speed times
+    # faster.
+    conn.bot.scheduler.start()
+    reader, writer = ReplayReader(), ReplayWriter(conn.bot.clock)
+    conn.adopt(reader, writer, LineReader(), ('replay', 0), conn.config['nick'])
+    count, last = 0, None
+    for stamp, network, line in records:
+        if clock is not None:
+            clock.now = max(clock.now, stamp)
+        elif last is not None and stamp > last:
+            await asyncio.sleep((stamp - last) / speed)
+        last = stamp
+        reader.queue.put_nowait((line + '\r\n').encode())
+        await reader.queue.join()
+        # tasks the line woke up (a WHO reply finishing a sync) get to send
+        # their next request before the server would have answered it
+        for _ in range(4):
+            await asyncio.sleep(0)
+        count += 1
+    # whatever the last lines set off (join batches, delayed ops)
+    for _ in range(100):
+        if clock is not None:
+            clock.now += 0.1
+        await asyncio.sleep(0 if clock is not None else 0.01)
+    reader.queue.put_nowait(b'')
+    await conn.closed.wait()
+    return count, writer.lines
+
+
+def replay(args):
+    # python3 protoGen.py replay capture.log: the received lines of one
+    # network through the bot's handlers, against copies of config.txt,
+    # owner.txt and fb.txt, printing the lines the bot would have sent
+    config = load_config()
+    for key in ('capture', 'link_secret', 'metrics_listen'):
+        config.pop(key, None)
+    records = list(read_capture(args.files, args.network))
+    if not records:
+        print("No received lines in the capture.")
+        return
+    networks = network_configs(config)
+    name = records[0][1] if records[0][1] in networks else next(iter(networks))
+    directory = tempfile.mkdtemp(prefix='protogen-replay-')
+    for file_name in ('owner.txt', 'fb.txt'):
+        if os.path.isfile(file_name):
+            shutil.copy(file_name, directory)
+    clock = ReplayClock(records[0][0], time.perf_counter) if args.speed <= 0 else None
+    loop = ReplayLoop(clock) if clock is not None else asyncio.new_event_loop()
+    random.seed(0)
+    owners = OwnerList(os.path.join(directory, 'owner.txt'))
+    fb = FbList(os.path.join(directory, 'fb.txt'))
+    timers = TimerList(os.path.join(directory, 'timers.txt'))
+    profile = None
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start(args.tracemalloc)
+    if args.profile:
+        import cProfile
+        profile = cProfile.Profile()
+    if args.verbose:
+        listener = setup_logging(dict(config, log_file=''))
+    else:
+        listener = None
+        logging.getLogger('protoGen').setLevel(logging.CRITICAL + 1)
+    started = time.perf_counter()
+    try:
+        asyncio.set_event_loop(loop)
+        bot = Bot(config, owners, fb, timers, clock or time)
+        conn = bot.connections[name]
+        if profile is not None:
+            profile.enable()
+        count, sent = loop.run_until_complete(replay_traffic(conn, records, args.speed, clock))
+        if profile is not None:
+            profile.disable()
+    finally:
+        # the bot's own tasks (syncs, requests, batches) are still pending
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
+        owners.close()
+        fb.close()
+        timers.close()
+        shutil.rmtree(directory, ignore_errors=True)
+        if listener is not None:
+            listener.stop()
+    elapsed = time.perf_counter() - started
+    print(f"Replayed {count} lines of {name} in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f} lines/s), "
+          f"the bot sent {len(sent)} lines.")
+    actions = [line for stamp, line in sent]
+    if args.actions:
+        with open(args.actions, 'w') as f:
+            f.writelines(line + '\n' for line in actions)
+    if args.expect:
+        with open(args.expect, 'r', errors='replace') as f:
+            expected = [line.rstrip('\n') for line in f]
+        diff = list(difflib.unified_diff(expected, actions, args.expect, 'replay', lineterm=''))
+        print('Same actions as ' + args.expect if not diff else '\n'.join(diff[:200]))
+    if profile is not None:
+        import pstats
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+    if args.tracemalloc:
+        current, peak = tracemalloc.get_traced_memory()
+        print(f"Memory: {current / 1024:.0f} KiB now, {peak / 1024:.0f} KiB peak")
+        for stat in tracemalloc.take_snapshot().statistics('lineno')[:15]:
+            print(stat)
+        tracemalloc.stop()
+
+
+def main():
+    config = {}
+    args = parse_arguments()
+
+    if args.command:
+        run_command(args)
+        return
+
+    if any(vars(args).values()):
+        if args.bind_ip:
+            config['bind_ip'] = args.bind_ip
+        if args.server:
+            config['server'] = args.server
+        if args.port:
+            config['port'] = args.port
+        if args.nick:
+            config['nick'] = args.nick
+        if args.owner:
+            with open('owner.txt', 'w') as f:
+                f.write(args.owner + '\n')
+        if args.channel and not args.channel.startswith('#'):
+            print("Invalid channel name. Use '#' before the channel name.")
+        else:
+            config['channel'] = args.channel
+
+        save_config(config)
+
+    # Check if required files exist, create them if they don't
+    if not os.path.isfile('config.txt'):
+        create_config()
+    if not os.path.isfile('owner.txt'):
+        create_owner()
+    if not os.path.isfile('fb.txt'):
+        open('fb.txt', 'a').close()
+
+    config = load_config()
+    listener = setup_logging(config)
+    owners = OwnerList()
+    fb = FbList()
+    timers = TimerList()
+
+    bot = Bot(config, owners, fb, timers)
+    try:
+        asyncio.run(bot.run())
+    finally:
+        if bot.capture is not None:
+            bot.capture.close()
+        owners.close()
+        fb.close()
+        timers.close()
+        listener.stop()
 
 
 # Add additional commands here